@@ -0,0 +1,1132 @@
+""" bench.py
+
+Benchmarks for the project2 package. Each benchmark compares a function of
+project2.main against the implementation it replaced, which is kept here as
+a reference.
+"""
+from __future__ import annotations
+
+import asyncio
+import builtins
+import contextlib
+import io
+import json
+import multiprocessing as mp
+import os
+import pickle
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from project2 import cache
+from project2 import config as cfg
+from project2 import factors
+from project2 import main
+from project2 import ols
+from project2 import shared
+from project2 import store
+
+
+#############################
+# Reference implementations #
+#############################
+def _normalise_legacy(name):
+    # normalise before the compiled regular expressions: three strings built
+    # character by character
+    name = name.strip()
+    if name.isupper():
+        name = name.lower()
+
+    cased_name = ''
+    for i, ch in enumerate(name):
+        if ch.isupper() and i != 0:
+            cased_name += '_' + ch.lower()
+        else:
+            cased_name += ch.lower()
+
+    new = ''
+    for ch in cased_name:
+        if ch.isalnum():
+            new += ch
+        else:
+            new += '_'
+
+    final = ''
+    prev = None
+    for ch in new:
+        if ch == '_' and prev == '_':
+            continue
+        final += ch
+        prev = ch
+    return final
+
+
+def _read_dat_legacy(pth, prc_col: str = 'adj_close') -> pd.DataFrame:
+    # read_dat before the streaming parser: the whole file is read with
+    # readlines, written to comma_dat.csv and parsed again from there
+    new_lines = []
+    if os.path.exists(pth):
+        with open(pth, 'r') as file:
+            content = file.readlines()
+            for line in content:
+                new_lines.append(" ".join(line.replace("'", "").split()))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        comma_path = os.path.join(tmpdir, 'comma_dat.csv')
+        with open(comma_path, 'w') as new_file:
+            for line in new_lines:
+                changed_line = line.replace(' ', ',') + '\n'
+                changed_line = changed_line.replace(',,', ',')
+                new_file.write(changed_line)
+        df = pd.read_csv(comma_path)
+
+        df.replace(-99, pd.NA, inplace=True)
+        df.dropna(inplace=True)
+        main.rename_cols(df, prc_col=prc_col)
+        df = df.sort_values(by=['ticker', 'date'])
+        df['open'] = np.abs(df['open'])
+        df.to_csv(os.path.join(tmpdir, 'clean_data.dat'), index=False)
+
+    return df[['date', 'ticker', 'price']]
+
+
+def _clean_dat_legacy(df: pd.DataFrame, prc_col: str = 'adj_close') -> pd.DataFrame:
+    # Cleaning of read_dat before clean_dat: replace, dropna, a sort by the
+    # ticker and date strings and np.abs, each a pass over the frame
+    df.replace(-99, pd.NA, inplace=True)
+    df.dropna(inplace=True)
+    main.rename_cols(df, prc_col=prc_col)
+    df = df.sort_values(by=['ticker', 'date'])
+    df['open'] = np.abs(df['open'])
+    return df
+
+
+def _read_csv_legacy(pth, ticker: str, prc_col: str = 'adj_close') -> pd.DataFrame:
+    # read_csv before the compact dtypes: date and ticker are strings
+    df = pd.read_csv(pth)
+    main.rename_cols(df, prc_col=prc_col)
+    df['ticker'] = ticker.upper()
+    df = df.sort_values(by=['ticker', 'date'])
+    return df[['date', 'ticker', 'price']]
+
+
+def _read_files_legacy(
+        csv_tickers: list | None = None,
+        dat_files: list | None = None,
+        prc_col: str = 'adj_close',
+        ) -> pd.DataFrame:
+    # read_files before iter_files: one pd.concat per file read
+    data = pd.DataFrame(columns=['date', 'ticker', 'price'])
+    if csv_tickers is not None:
+        for tic in csv_tickers:
+            pth = os.path.join(cfg.DATADIR, f'{tic.lower()}_prc.csv')
+            if os.path.isfile(pth):
+                data = pd.concat([data, _read_csv_legacy(pth, tic, prc_col)], ignore_index=True)
+    if dat_files is not None:
+        for dat in dat_files:
+            df_dat = _read_dat_legacy(os.path.join(cfg.DATADIR, f'{dat}'), prc_col)
+            data = pd.concat([data, df_dat], ignore_index=True)
+
+    data.drop_duplicates(subset=['date', 'ticker'], keep='first', inplace=True)
+    return data.sort_values(by=['ticker', 'date'])
+
+
+def _merge_ticker_legacy(frames) -> pd.DataFrame:
+    # _merge_ticker before the merge of sorted runs: the frames are
+    # concatenated, deduplicated by hashing and sorted again
+    data = main._concat_canonical(frames)
+    data.drop_duplicates(subset=['date'], keep='first', inplace=True)
+    return data.sort_values(by='date', ignore_index=True)
+
+
+def _compute_monthly_volatility_legacy(df: pd.DataFrame) -> pd.DataFrame:
+    # compute_monthly_volatility before the grouped reduction: np.std is
+    # called from Python once per ticker-month
+    df['mdate'] = df['date'].dt.to_period('M').astype(str)
+    m_vol = df.groupby(['ticker', 'mdate'])['dret'].agg(lambda x: np.std(x) * np.sqrt(21)).reset_index()
+    m_vol.rename(columns={'dret': 'mvol'}, inplace=True)
+    return m_vol[['ticker', 'mdate', 'mvol']]
+
+
+def _calc_monthly_ret_and_vol_unfused(df: pd.DataFrame) -> pd.DataFrame:
+    # calc_monthly_ret_and_vol before compute_monthly_data: two groupbys
+    # followed by a merge
+    df = main.compute_daily_returns(main.format_data_calc(df))
+    monthly_returns = main.compute_monthly_returns(df)
+    monthly_volatility = main.compute_monthly_volatility(df)
+    return main.merge_monthly_data(monthly_returns, monthly_volatility)
+
+
+####################
+# Helper Functions #
+####################
+def _proc_io():
+    # Characters read and written by this process (Linux only)
+    try:
+        with open('/proc/self/io') as fobj:
+            stats = dict(line.split(': ') for line in fobj.read().splitlines())
+        return int(stats['rchar']), int(stats['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _rss_mb(field):
+    # VmRSS (current) or VmHWM (peak) resident set size of this process in
+    # MB (Linux only)
+    try:
+        with open('/proc/self/status') as fobj:
+            for line in fobj:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Reset VmHWM to the current RSS, so that the peak of what runs next is
+    # not hidden by the peak of the imports (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as fobj:
+            fobj.write('5')
+    except OSError:
+        pass
+
+
+def _measure(func, args, queue, setup=None):
+    # Runs in a fresh process so that the peak RSS belongs to `func` alone
+    if setup is not None:
+        args = setup(*args)
+    _reset_peak_rss()
+    rss0 = _rss_mb('VmRSS')
+    rchar0, wchar0 = _proc_io()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    rchar1, wchar1 = _proc_io()
+    peak = _rss_mb('VmHWM')
+    if peak is None:
+        # ru_maxrss is in kilobytes on Linux
+        peak = rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put({
+        'seconds': elapsed,
+        'bytes_read': None if rchar0 is None else rchar1 - rchar0,
+        'bytes_written': None if wchar0 is None else wchar1 - wchar0,
+        'peak_rss_mb': peak,
+        # Growth of the peak over the RSS after imports and setup
+        'peak_rss_delta_mb': peak - rss0,
+        })
+
+
+def measure(func, *args, setup=None) -> dict:
+    """ Run `func(*args)` in a new process and return its wall time, bytes
+    read and written, and peak resident set size. If given, `setup(*args)`
+    runs first in the same process, untimed, and returns the arguments of
+    `func` instead.
+    """
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure, args=(func, args, queue, setup))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+@contextlib.contextmanager
+def _datadir(pth):
+    # Point cfg.DATADIR to `pth` for the duration of the block
+    old = cfg.DATADIR
+    cfg.DATADIR = pth
+    try:
+        yield pth
+    finally:
+        cfg.DATADIR = old
+
+
+@contextlib.contextmanager
+def slow_open(latency: float = 0.05):
+    """ Make every call to open wait `latency` seconds first, as opening a
+    file on a network mount does, for the duration of the block
+    """
+    real_open = builtins.open
+
+    def open_(*args, **kwargs):
+        time.sleep(latency)
+        return real_open(*args, **kwargs)
+
+    builtins.open = open_
+    try:
+        yield
+    finally:
+        builtins.open = real_open
+
+
+def make_synthetic_panel(
+        n_tickers: int = 500,
+        years: int = 5,
+        seed: int = 0,
+        ) -> pd.DataFrame:
+    """ Random daily prices for `n_tickers` tickers over `years` years of
+    business days, as a date/ticker/price frame like the output of
+    read_files
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=252 * years).strftime('%Y-%m-%d')
+    rets = rng.normal(0, 0.02, (n_tickers, len(dates)))
+    return pd.DataFrame({
+        'date': np.tile(dates, n_tickers),
+        'ticker': np.repeat([f'T{i:04d}' for i in range(n_tickers)], len(dates)),
+        'price': (20 * np.exp(np.cumsum(rets, axis=1))).ravel(),
+        })
+
+
+def _messy_dat_lines(dat, rng, missing_rate, noise_rate):
+    # Lines of the .dat file of the frame `dat`, with the defects of
+    # data1.dat: a `missing_rate` share of rows with -99 for the open and
+    # adjusted close prices, and a `noise_rate` share of rows with one of a
+    # negative open price, a quoted ticker, a trailing space after the
+    # ticker or tabs instead of commas
+    n = len(dat)
+    fields = {col: dat[col].astype(str) for col in ['TICKER', 'Volume', 'Date']}
+    for col in ['Open', 'Close', 'High', 'Low', 'Adj Close']:
+        fields[col] = dat[col].map('{:.4f}'.format)
+
+    missing = rng.random(n) < missing_rate
+    fields['Open'] = fields['Open'].mask(missing, '-99')
+    fields['Adj Close'] = fields['Adj Close'].mask(missing, '-99')
+
+    noise = np.where(rng.random(n) < noise_rate, rng.integers(0, 4, n), -1)
+    fields['Open'] = fields['Open'].mask((noise == 0) & ~missing, '-' + fields['Open'])
+    fields['TICKER'] = fields['TICKER'].mask(noise == 1, "' " + fields['TICKER'] + "'")
+    fields['TICKER'] = fields['TICKER'].mask(noise == 2, fields['TICKER'] + ' ')
+
+    cols = ['TICKER', 'Volume', 'Open', 'Close', 'High', 'Low', 'Adj Close', 'Date']
+    commas = fields[cols[0]].str.cat([fields[col] for col in cols[1:]], sep=',')
+    tabs = fields[cols[0]].str.cat([fields[col] for col in cols[1:]], sep='\t')
+    return commas.mask(noise == 3, tabs)
+
+
+def make_synthetic_datadir(
+        root,
+        n_tickers: int = 500,
+        years: int = 5,
+        dat_share: float = 0.5,
+        seed: int = 0,
+        missing_rate: float = 0.0,
+        noise_rate: float = 0.0,
+        ) -> tuple[list, list]:
+    """ Write random daily prices for `n_tickers` tickers to the folder
+    `root`, laid out as in cfg.DATADIR: one <ticker>_prc.csv file per ticker
+    and a synthetic.dat file with the first `dat_share` of the tickers.
+
+    The .dat file has the format of data1.dat. A `missing_rate` share of its
+    rows have -99 prices and a `noise_rate` share have a negative open
+    price, a quoted or padded ticker or tab separators (see
+    _messy_dat_lines).
+
+    Returns
+    -------
+    tuple:
+        The list of CSV tickers and the list of DAT files, as expected by
+        read_files
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=252 * years)
+    tickers = [f'T{i:04d}' for i in range(n_tickers)]
+    dat_frames = []
+    for i, tic in enumerate(tickers):
+        prc = 20 * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates))))
+        df = pd.DataFrame({
+            'Date': dates.strftime('%Y-%m-%d'),
+            'Open': prc * (1 + rng.normal(0, 0.005, len(dates))),
+            'High': prc * 1.01,
+            'Low': prc * 0.99,
+            'Close': prc,
+            'Adj Close': prc,
+            'Volume': rng.integers(0, 100, len(dates)),
+            })
+        df.to_csv(os.path.join(root, f'{tic.lower()}_prc.csv'), index=False)
+        if i < n_tickers * dat_share:
+            dat_frames.append(df.assign(TICKER=tic))
+
+    if dat_frames:
+        dat = pd.concat(dat_frames, ignore_index=True)
+        dat = dat[['TICKER', 'Volume', 'Open', 'Close', 'High', 'Low', 'Adj Close', 'Date']]
+        with open(os.path.join(root, 'synthetic.dat'), 'w') as fobj:
+            # Quoted, like the header of data1.dat, so the white space inside
+            # "Adj  Close" does not split it
+            fobj.write('TICKER,Volume,Open,Close,High,Low,"Adj  Close",Date\n')
+            if missing_rate or noise_rate:
+                lines = _messy_dat_lines(dat, rng, missing_rate, noise_rate)
+                fobj.write('\n'.join(lines) + '\n')
+            else:
+                dat.to_csv(fobj, index=False, header=False)
+        return tickers, ['synthetic.dat']
+    return tickers, []
+
+
+def _calc_from_text(root, csv_tickers, dat_files):
+    # Cold start of an analysis run from the text files of `root`
+    with _datadir(root):
+        return main.calc_monthly_ret_and_vol(main.read_files(csv_tickers, dat_files))
+
+
+def _calc_from_store(pth):
+    # Cold start of an analysis run from the store `pth`
+    return main.calc_monthly_ret_and_vol(store.open_store(pth).iter_frames())
+
+
+def _read_files_in(root, csv_tickers, dat_files, export_dir=None):
+    # read_files on the folder `root`, exporting to `export_dir` if given
+    with _datadir(root):
+        return main.read_files(csv_tickers, dat_files, export_dir=export_dir)
+
+
+def _iter_dat_rows(root, dat_files, workers, chunksize):
+    # Rows of the DAT files of `root` read by iter_files, one ticker at a time
+    with _datadir(root):
+        return sum(len(df) for df in main.iter_files(dat_files=dat_files, workers=workers,
+                                                     chunksize=chunksize))
+
+
+def _stage_read_dat(root, dat_files):
+    with _datadir(root):
+        for dat in dat_files:
+            main.read_dat(os.path.join(root, dat))
+
+
+def _stage_read_csv(root, csv_tickers):
+    with _datadir(root):
+        for tic in csv_tickers:
+            main.read_csv(os.path.join(root, f'{tic.lower()}_prc.csv'), tic)
+
+
+def _stage_calc_setup(root, csv_tickers, dat_files):
+    # The daily panel, read before calc_monthly_ret_and_vol is timed
+    return (_read_files_in(root, csv_tickers, dat_files),)
+
+
+def _stage_main(root, csv_tickers, dat_files):
+    # main prints the regression summary, which is not part of the report
+    with _datadir(root), contextlib.redirect_stdout(io.StringIO()):
+        main.main(csv_tickers, dat_files)
+
+
+def _file_stats(pths):
+    # Number of data lines (excluding headers) and bytes of the files `pths`
+    rows = size = 0
+    for pth in pths:
+        with open(pth, 'rb') as fobj:
+            data = fobj.read()
+        rows += data.count(b'\n') - 1
+        size += len(data)
+    return rows, size
+
+
+# Modules which the ingestion and monthly calculation code must not import
+LAZY_MODULES = ('statsmodels', 'scipy', 'matplotlib', 'seaborn')
+
+
+def import_time(module: str = 'project2.main') -> tuple[float, list]:
+    """ Import `module` in a new interpreter with -X importtime. Returns
+    its cumulative import time in seconds and the LAZY_MODULES it loaded.
+    """
+    pkg_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    # config imports toolkit_config from the package folder
+    env['PYTHONPATH'] = os.pathsep.join(
+        pth for pth in [pkg_dir, os.path.dirname(pkg_dir), env.get('PYTHONPATH')] if pth)
+    code = f'import sys, {module}; print(*[m for m in {LAZY_MODULES!r} if m in sys.modules])'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          env=env, capture_output=True, text=True, check=True)
+
+    # Lines are "import time: <self us> | <cumulative us> | <module>"
+    for line in proc.stderr.splitlines():
+        fields = line.removeprefix('import time:').split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6, proc.stdout.split()
+    raise RuntimeError(f'{module} was not imported: {proc.stderr[-500:]}')
+
+
+def _print_results(title, results):
+    print(title)
+    print(pd.DataFrame(results).T.to_string(float_format=lambda x: f'{x:,.3f}'))
+
+
+##############
+# Benchmarks #
+##############
+def bench_read_dat(pth=None):
+    """ Compare the streaming read_dat against the comma_dat.csv round-trip
+    """
+    if pth is None:
+        pth = os.path.join(cfg.DATADIR, 'data1.dat')
+    results = {
+        'legacy': measure(_read_dat_legacy, pth),
+        'stream': measure(main.read_dat, pth),
+        }
+    _print_results(f'read_dat: {pth} ({os.path.getsize(pth):,} bytes)', results)
+    return results
+
+
+def bench_cache(pth=None):
+    """ Compare a parsing read_dat against a cold and a warm cached one
+    """
+    if pth is None:
+        pth = os.path.join(cfg.DATADIR, 'data1.dat')
+    cache.invalidate(pth)
+    results = {
+        'no cache': measure(main.read_dat, pth),
+        'cold': measure(main.read_dat, pth, 'adj_close', True),
+        'warm': measure(main.read_dat, pth, 'adj_close', True),
+        }
+    _print_results(f'read_dat cache ({cache.EXT}): {pth}', results)
+    cache.invalidate(pth)
+    return results
+
+
+def bench_clean_dat(n_tickers: int = 500, years: int = 20):
+    """ Compare clean_dat against the cleaning it replaced on the parsed rows
+    of a messy synthetic .dat file
+    """
+    with tempfile.TemporaryDirectory() as root:
+        _, dat_files = make_synthetic_datadir(root, n_tickers, years, dat_share=1.0,
+                                              missing_rate=0.03, noise_rate=0.25)
+        with main._DatStream(os.path.join(root, dat_files[0])) as stream:
+            raw = pd.read_csv(stream)
+
+    def best(func):
+        # Best wall time of 3 calls on copies of the parsed rows
+        seconds = float('inf')
+        for _ in range(3):
+            df = raw.copy()
+            start = time.perf_counter()
+            result = func(df)
+            seconds = min(seconds, time.perf_counter() - start)
+        return seconds, result
+
+    legacy_seconds, expected = best(_clean_dat_legacy)
+    seconds, (result, report) = best(main.clean_dat)
+    results = {
+        'legacy': {'seconds': legacy_seconds},
+        'clean_dat': {
+            'seconds': seconds,
+            'same_output': expected.reset_index(drop=True).astype({'open': float, 'price': float}).equals(
+                result.reset_index(drop=True)),
+            },
+        }
+    _print_results(f'clean_dat: {len(raw):,} rows', results)
+    print(report.sum().to_string())
+    return results
+
+
+def bench_merge_ticker(n_tickers: int = 200, years: int = 40, n_chunks: int = 4):
+    """ Compare the merge of the sorted CSV and DAT frames of each ticker
+    against concatenating, deduplicating and sorting them. Each ticker has
+    a CSV frame with all its dates and `n_chunks` DAT frames, each with a
+    random half of them.
+    """
+    rng = np.random.default_rng(0)
+    panel = main.to_canonical(make_synthetic_panel(n_tickers, years))
+    inputs = []
+    for _, df in panel.groupby('ticker', observed=True):
+        df = df.reset_index(drop=True)
+        dat = [df[rng.random(len(df)) < 0.5].assign(price=lambda d: d['price'] * 2)
+               for _ in range(n_chunks)]
+        inputs.append([df] + dat)
+
+    def merge_all(merge):
+        return [merge(frames) for frames in inputs]
+
+    expected = merge_all(_merge_ticker_legacy)
+    result = merge_all(main._merge_ticker)
+    results = {
+        'concat+sort': {'seconds': _time(merge_all, _merge_ticker_legacy)},
+        'merge': {
+            'seconds': _time(merge_all, main._merge_ticker),
+            'same_output': all(a.equals(b) for a, b in zip(expected, result)),
+            },
+        }
+    rows = sum(len(df) for frames in inputs for df in frames)
+    _print_results(f'_merge_ticker: {n_tickers} tickers, {rows:,} rows in', results)
+    return results
+
+
+def bench_read_files_workers(n_tickers: int = 500, max_workers: int | None = None):
+    """ Time read_files over a synthetic folder of `n_tickers` tickers with
+    1, 2, 4, ... up to `max_workers` processes
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    counts = sorted({min(2 ** i, max_workers) for i in range(max_workers.bit_length() + 1)})
+    results = {}
+    with tempfile.TemporaryDirectory() as root, _datadir(root):
+        csv_tickers, dat_files = make_synthetic_datadir(root, n_tickers)
+        expected = None
+        for workers in counts:
+            start = time.perf_counter()
+            df = main.read_files(csv_tickers, dat_files, workers=workers)
+            elapsed = time.perf_counter() - start
+            if expected is None:
+                expected = df
+            results[f'workers={workers}'] = {
+                'seconds': elapsed,
+                'speedup': results['workers=1']['seconds'] / elapsed if results else 1.0,
+                'same_output': df.equals(expected),
+                }
+    _print_results(f'read_files: {n_tickers} synthetic tickers', results)
+    return results
+
+
+def bench_iter_files_workers(n_tickers: int = 500, years: int = 20, chunksize: int = 100_000,
+                             max_workers: int | None = None):
+    """ Time and peak memory of iter_files over a single synthetic .dat file
+    of `n_tickers` tickers with 1, 2, 4, ... up to `max_workers` processes,
+    which split the file into pieces of about `chunksize` rows. The sidecar
+    index is built first, untimed.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    counts = sorted({min(2 ** i, max_workers) for i in range(max_workers.bit_length() + 1)})
+    results = {}
+    with tempfile.TemporaryDirectory() as root, _datadir(root):
+        _, dat_files = make_synthetic_datadir(root, n_tickers, years, dat_share=1.0)
+        main._dat_index(os.path.join(root, dat_files[0]))
+        for workers in counts:
+            res = measure(_iter_dat_rows, root, dat_files, workers, chunksize)
+            res['speedup'] = results['workers=1']['seconds'] / res['seconds'] if results else 1.0
+            results[f'workers={workers}'] = res
+    _print_results(f'iter_files: one .dat file of {n_tickers} synthetic tickers, {years} years', results)
+    return results
+
+
+def _time(func, *args, repeat: int = 3) -> float:
+    # Best wall time of `repeat` calls
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_monthly_volatility(n_tickers: int = 500, years: int = 20):
+    """ Compare compute_monthly_volatility against the per-group lambda on a
+    synthetic panel
+    """
+    df = main.compute_daily_returns(main.format_data_calc(make_synthetic_panel(n_tickers, years)))
+    expected = _compute_monthly_volatility_legacy(df.copy())
+    result = main.compute_monthly_volatility(df.copy())
+    results = {
+        'lambda': {'seconds': _time(_compute_monthly_volatility_legacy, df.copy(), repeat=1)},
+        'grouped': {'seconds': _time(main.compute_monthly_volatility, df.copy())},
+        }
+    results['grouped']['max_abs_diff'] = (expected['mvol'] - result['mvol']).abs().max()
+    _print_results(f'compute_monthly_volatility: {len(df):,} rows', results)
+    return results
+
+
+def bench_calc_monthly_ret_and_vol(n_tickers: int = 500, years: int = 20):
+    """ Compare the fused calc_monthly_ret_and_vol against two groupbys and
+    a merge on a synthetic panel
+    """
+    df = make_synthetic_panel(n_tickers, years)
+    expected = _calc_monthly_ret_and_vol_unfused(df.copy()).reset_index(drop=True)
+    result = main.calc_monthly_ret_and_vol(df.copy())
+    results = {
+        'unfused': {'seconds': _time(_calc_monthly_ret_and_vol_unfused, df.copy())},
+        'fused': {'seconds': _time(main.calc_monthly_ret_and_vol, df.copy())},
+        }
+    results['fused']['max_abs_diff'] = (expected[['mret', 'mvol']] - result[['mret', 'mvol']]).abs().max().max()
+    _print_results(f'calc_monthly_ret_and_vol: {len(df):,} rows', results)
+    return results
+
+
+def bench_multi_price(n_tickers: int = 200, years: int = 5):
+    """ Compare monthly results for the adj_close, close and open prices of
+    a synthetic folder: one read_files and calc_monthly_ret_and_vol per
+    column against a single read of all three and one batched calc
+    """
+    cols = ['adj_close', 'close', 'open']
+
+    def per_column(csv_tickers, dat_files):
+        return [main.calc_monthly_ret_and_vol(main.read_files(csv_tickers, dat_files, prc_col=col))
+                for col in cols]
+
+    def batched(csv_tickers, dat_files):
+        wide = main.read_files(csv_tickers, dat_files, prc_col=cols)
+        return main.calc_monthly_ret_and_vol(wide, prc_cols=cols)
+
+    with tempfile.TemporaryDirectory() as root, _datadir(root):
+        csv_tickers, dat_files = make_synthetic_datadir(root, n_tickers, years)
+        expected = per_column(csv_tickers, dat_files)
+        result = batched(csv_tickers, dat_files)
+        same = all(
+            exp.equals(result[result['prc_col'] == col].drop(columns='prc_col').reset_index(drop=True))
+            for col, exp in zip(cols, expected))
+        results = {
+            'per column': {'seconds': _time(per_column, csv_tickers, dat_files, repeat=1)},
+            'batched': {'seconds': _time(batched, csv_tickers, dat_files, repeat=1),
+                        'same_output': same},
+            }
+    _print_results(f'{len(cols)} price columns: {n_tickers} synthetic tickers', results)
+    return results
+
+
+def _calc_pickled(frames, workers):
+    # calc_monthly_ret_and_vol of the shard frames `frames` on `workers`
+    # processes, pickling each frame to its worker and its result back
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(main.calc_monthly_ret_and_vol, frames))
+    return pd.concat(results, ignore_index=True)
+
+
+def bench_shared(n_tickers: int = 500, years: int = 20, workers: int = 2):
+    """ Compare calc_monthly_ret_and_vol sharded by ticker over `workers`
+    processes when the shards and their results are pickled, against
+    shared.calc_sharded, which passes them through shared memory. Also
+    reports the bytes pickled between processes by each.
+    """
+    df = main.to_canonical(make_synthetic_panel(n_tickers, years))
+    shards = 4 * workers
+    codes = df['ticker'].cat.codes.to_numpy()
+    bounds = shared._shard_bounds(codes, shards)
+    frames = [df.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    start = time.perf_counter()
+    expected = _calc_pickled(frames, workers)
+    pickled_seconds = time.perf_counter() - start
+    pickled_bytes = sum(len(pickle.dumps(frame)) for frame in frames)
+    pickled_bytes += sum(len(pickle.dumps(main.calc_monthly_ret_and_vol(frame))) for frame in frames)
+
+    start = time.perf_counter()
+    result = shared.calc_sharded(df, workers=workers, shards=shards)
+    shared_seconds = time.perf_counter() - start
+    with shared.share(df.iloc[:1]) as panel:
+        # Descriptors of the panel and of the results, their bounds and the
+        # row count returned, for each shard
+        shared_bytes = len(bounds[:-1]) * (2 * len(pickle.dumps(panel.descriptor)) + 4 * 8)
+
+    results = {
+        'pickled': {'seconds': pickled_seconds, 'bytes_pickled': pickled_bytes},
+        'shared memory': {'seconds': shared_seconds, 'bytes_pickled': shared_bytes,
+                          'same_output': expected.equals(result)},
+        }
+    _print_results(f'sharded calc_monthly_ret_and_vol: {len(df):,} rows, {workers} workers', results)
+    return results
+
+
+def bench_result_cache(n_tickers: int = 500, years: int = 20):
+    """ Time calc_monthly_ret_and_vol on a synthetic panel without caching,
+    on a first memoized call, and when its result is found in memory or on
+    disk (as in a new run)
+    """
+    df = main.to_canonical(make_synthetic_panel(n_tickers, years))
+    with tempfile.TemporaryDirectory() as results_dir:
+        default_dir, cache.RESULTS_DIR = cache.RESULTS_DIR, results_dir
+        try:
+            cache.clear_results()
+            expected = main.calc_monthly_ret_and_vol(df)
+            results = {'no cache': {'seconds': _time(main.calc_monthly_ret_and_vol, df)}}
+
+            start = time.perf_counter()
+            main.calc_monthly_ret_and_vol(df, disk_cache=True)
+            results['miss'] = {'seconds': time.perf_counter() - start}
+
+            start = time.perf_counter()
+            result = main.calc_monthly_ret_and_vol(df, use_cache=True)
+            results['memory hit'] = {'seconds': time.perf_counter() - start,
+                                     'same_output': result.equals(expected)}
+
+            cache.clear_results()
+            start = time.perf_counter()
+            result = main.calc_monthly_ret_and_vol(df, disk_cache=True)
+            results['disk hit'] = {'seconds': time.perf_counter() - start,
+                                   'same_output': result.equals(expected)}
+            results['hash only'] = {'seconds': _time(cache.frame_hash, df)}
+        finally:
+            cache.clear_results()
+            cache.RESULTS_DIR = default_dir
+    _print_results(f'memoized calc_monthly_ret_and_vol: {len(df):,} rows', results)
+    return results
+
+
+def bench_month_keys(n_tickers: int = 500, years: int = 20):
+    """ Compare YYYY-MM string mdate keys against integer month keys on a
+    synthetic panel: time to build them, their memory and a groupby on them
+    """
+    df = main.compute_daily_returns(main.format_data_calc(make_synthetic_panel(n_tickers, years)))
+
+    def str_keys():
+        return df['date'].dt.to_period('M').astype(str)
+
+    def int_keys():
+        return pd.Series(main.month_key(df['date']), index=df.index)
+
+    results = {}
+    for name, func in [('str', str_keys), ('int32', int_keys)]:
+        keys = func()
+        results[name] = {
+            'build_seconds': _time(func),
+            'memory_mb': keys.memory_usage(deep=True) / 2 ** 20,
+            'groupby_seconds': _time(lambda: df['dret'].groupby([df['ticker'], keys]).std(ddof=0)),
+            }
+    _print_results(f'mdate keys: {len(df):,} rows', results)
+    return results
+
+
+def bench_compact_dtypes(n_tickers: int = 2000, years: int = 20):
+    """ Compare the memory footprint of a synthetic daily panel (10M rows
+    by default) as read_files used to return it, with object columns,
+    against the canonical dtypes of main.to_canonical
+    """
+    legacy = make_synthetic_panel(n_tickers, years).astype(object)
+    compact = main.to_canonical(legacy)
+    results = {
+        'object': main.memory_report(legacy),
+        'canonical': main.memory_report(compact),
+        }
+    for res in results.values():
+        res['total_mb'] = res['total'] / 2 ** 20
+    _print_results(f'date/ticker/price memory: {len(legacy):,} rows', results)
+    return results
+
+
+def bench_normalise(n_files: int = 10_000, n_cols: int = 200, n_headers: int = 20):
+    """ Time the normalisation of the headers of `n_files` files with
+    `n_cols` columns each, drawn from `n_headers` distinct vendor headers
+    """
+    base = ['TICKER', 'Volume', 'Open', 'Close', 'High', 'Low', 'Adj  Close', 'Date']
+    headers = [tuple(f'{name} {i}' if i else name for i in range(n_cols // len(base) + 1)
+                     for name in base)[:n_cols] + (f'VendorField{h}',)
+               for h in range(n_headers)]
+    files = [headers[i % n_headers] for i in range(n_files)]
+
+    def legacy():
+        return [[_normalise_legacy(col) for col in cols] for cols in files]
+
+    def columns():
+        main.normalise.cache_clear()
+        return [[main.normalise(col) for col in cols] for cols in files]
+
+    def header():
+        main.normalise.cache_clear()
+        main.normalise_header.cache_clear()
+        return [main.normalise_header(cols) for cols in files]
+
+    expected = legacy()
+    results = {}
+    for name, func in [('legacy', legacy), ('normalise', columns), ('normalise_header', header)]:
+        results[name] = {
+            'seconds': _time(func),
+            'same_output': [list(cols) for cols in func()] == expected,
+            }
+    _print_results(f'normalise: {n_files:,} files x {n_cols} columns', results)
+    return results
+
+
+def _monthly_panel(n_tickers, years):
+    # Synthetic monthly data with lagged_mvol, as regressed in main
+    monthly_data = main.calc_monthly_ret_and_vol(make_synthetic_panel(n_tickers, years))
+    monthly_data['lagged_mvol'] = monthly_data.groupby('ticker')['mvol'].shift(1)
+    return monthly_data.dropna()
+
+
+def bench_batch_ols(n_tickers: int = 500, years: int = 20):
+    """ Compare one batch_ols call by ticker against a loop of smf.ols fits
+    """
+    import statsmodels.formula.api as smf
+
+    monthly_data = _monthly_panel(n_tickers, years)
+    groups = [df for _, df in monthly_data.groupby('ticker')]
+
+    def loop():
+        return [smf.ols(formula='mret ~ lagged_mvol', data=df).fit().params.to_numpy() for df in groups]
+
+    def batch():
+        return ols.batch_ols(monthly_data, 'mret', 'lagged_mvol', by='ticker')
+
+    expected = np.concatenate(loop())
+    results = {
+        'smf.ols loop': {'seconds': _time(loop, repeat=1)},
+        'batch_ols': {'seconds': _time(batch)},
+        }
+    results['batch_ols']['max_abs_diff'] = np.abs(batch()['coef'].to_numpy() - expected).max()
+    _print_results(f'OLS: {len(groups)} tickers, {len(monthly_data):,} rows', results)
+    return results
+
+
+def bench_rolling_ols(n_tickers: int = 500, years: int = 20, window: int = 60):
+    """ Time rolling_ols by ticker over `window`-month windows against
+    refitting smf.ols on every window, which is timed on one ticker and
+    extrapolated to all of them
+    """
+    import statsmodels.formula.api as smf
+
+    monthly_data = _monthly_panel(n_tickers, years)
+    one = monthly_data[monthly_data['ticker'] == monthly_data['ticker'].iloc[0]]
+
+    def refit_one():
+        for end in range(window - 1, len(one)):
+            smf.ols(formula='mret ~ lagged_mvol', data=one.iloc[end - window + 1:end + 1]).fit()
+
+    def rolling():
+        return ols.rolling_ols(monthly_data, 'mret', 'lagged_mvol', window=window)
+
+    results = {
+        'smf.ols refits (extrapolated)': {'seconds': _time(refit_one, repeat=1) * n_tickers},
+        'rolling_ols': {'seconds': _time(rolling)},
+        }
+    results['rolling_ols']['windows'] = len(rolling()) // 2
+    _print_results(f'rolling OLS: {n_tickers} tickers, {window}-month windows', results)
+    return results
+
+
+def bench_store(n_tickers: int = 500, years: int = 5, n_random: int = 50):
+    """ Compare the text files of a synthetic folder against the binary
+    store converted from them: cold start of calc_monthly_ret_and_vol in a
+    new process, and reading `n_random` random tickers
+    """
+    with tempfile.TemporaryDirectory() as root, _datadir(root):
+        csv_tickers, dat_files = make_synthetic_datadir(root, n_tickers, years)
+        pth = os.path.join(root, 'prices.bin')
+        start = time.perf_counter()
+        prices = store.convert(pth, csv_tickers, dat_files)
+        convert_seconds = time.perf_counter() - start
+
+        rng = np.random.default_rng(0)
+        sample = [str(tic) for tic in rng.choice(prices.tickers, n_random, replace=False)]
+
+        def random_text():
+            return [main.read_csv(os.path.join(root, f'{tic.lower()}_prc.csv'), tic) for tic in sample]
+
+        def random_store(prices):
+            return [prices.frame(tic) for tic in sample]
+
+        results = {
+            'text': measure(_calc_from_text, root, csv_tickers, dat_files),
+            'store': measure(_calc_from_store, pth),
+            }
+        results['text']['random_seconds'] = _time(random_text)
+        results['store']['random_seconds'] = _time(random_store, prices)
+        results['store']['convert_seconds'] = convert_seconds
+        results['store']['size_mb'] = os.path.getsize(pth) / 2 ** 20
+        # Unmap the records before the folder is removed
+        del prices
+    _print_results(f'store: {n_tickers} synthetic tickers, cold start and {n_random} random tickers',
+                   results)
+    return results
+
+
+def bench_exports(n_tickers: int = 200, years: int = 5):
+    """ Bytes written by read_files over a synthetic folder by default,
+    which spills nothing for files of at most a chunk, and when exporting
+    read_files.csv to a run folder, as every call used to
+    """
+    with tempfile.TemporaryDirectory() as root, _datadir(root):
+        csv_tickers, dat_files = make_synthetic_datadir(root, n_tickers, years)
+        results = {
+            'default': measure(_read_files_in, root, csv_tickers, dat_files),
+            'export': measure(_read_files_in, root, csv_tickers, dat_files, main.new_run_dir(root)),
+            }
+    _print_results(f'read_files writes: {n_tickers} synthetic tickers', results)
+    return results
+
+
+def bench_read_files_async(n_tickers: int = 100, years: int = 5, latency: float = 0.05):
+    """ Compare read_files against read_files_async over a synthetic folder
+    where opening a file takes `latency` seconds (see slow_open)
+    """
+    with tempfile.TemporaryDirectory() as root, _datadir(root):
+        csv_tickers, dat_files = make_synthetic_datadir(root, n_tickers, years)
+        with slow_open(latency):
+            start = time.perf_counter()
+            expected = main.read_files(csv_tickers, dat_files)
+            results = {'sequential': {'seconds': time.perf_counter() - start}}
+            for concurrency in [4, 16]:
+                start = time.perf_counter()
+                df = asyncio.run(main.read_files_async(csv_tickers, dat_files, max_concurrency=concurrency))
+                elapsed = time.perf_counter() - start
+                results[f'async, max_concurrency={concurrency}'] = {
+                    'seconds': elapsed,
+                    'speedup': results['sequential']['seconds'] / elapsed,
+                    'same_output': df.equals(expected),
+                    }
+    _print_results(f'read_files: {n_tickers} synthetic tickers, {latency}s per open', results)
+    return results
+
+
+def bench_factor_alignment(n_tickers: int = 500, years: int = 20):
+    """ Compare adding the monthly Fama-French factors to the monthly data
+    of each ticker with one pd.merge per ticker against the memoized month
+    index of factors.add_factors
+    """
+    monthly_data = main.calc_monthly_ret_and_vol(make_synthetic_panel(n_tickers, years), mdate_str=False)
+    # Synthetic dates start in 2000, which ff_daily.csv covers
+    groups = [df for _, df in monthly_data.groupby('ticker')]
+    factor_frame = factors.monthly_factors().to_frame(mdate_str=False)
+
+    def merge():
+        return pd.concat([df.merge(factor_frame, on='mdate', how='left') for df in groups])
+
+    def lookup():
+        return pd.concat([factors.add_factors(df) for df in groups])
+
+    def lookup_once():
+        return factors.add_factors(monthly_data)
+
+    expected = merge()[factors.FACTORS].to_numpy()
+    results = {}
+    for name, func in [('merge per ticker', merge), ('lookup per ticker', lookup),
+                       ('lookup, all tickers', lookup_once)]:
+        results[name] = {
+            'seconds': _time(func),
+            'same_output': np.allclose(func()[factors.FACTORS].to_numpy(), expected, equal_nan=True),
+            }
+    _print_results(f'factor alignment: {n_tickers} tickers, {len(monthly_data):,} months', results)
+    return results
+
+
+def bench_import_time(
+        modules=('project2.main', 'project2.store', 'project2.incremental', 'project2.model'),
+        repeat: int = 5,
+        ):
+    """ Best cumulative import time of each of `modules` over `repeat` new
+    interpreters, and the heavy modules it loads eagerly
+    """
+    results = {}
+    for module in modules:
+        times, loaded = [], []
+        for _ in range(repeat):
+            seconds, loaded = import_time(module)
+            times.append(seconds)
+        results[module] = {'seconds': min(times), 'loaded': ' '.join(loaded) or '-'}
+    _print_results('import time (-X importtime)', results)
+    return results
+
+
+# Default location of the saved baseline of bench_pipeline
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+
+def bench_pipeline(
+        n_tickers: int = 200,
+        years: int = 5,
+        missing_rate: float = 0.01,
+        noise_rate: float = 0.05,
+        baseline: str | None = BASELINE_PATH,
+        update_baseline: bool = False,
+        tolerance: float = 0.25,
+        ) -> dict:
+    """ Time each stage of the pipeline, from reading the files to the
+    regression, on a synthetic folder with messy .dat rows (see
+    make_synthetic_datadir), each stage in a new process.
+
+    Each stage reports its wall time, throughput in input rows and MB per
+    second, and peak memory. The import time of project2.main (see
+    import_time) is tracked as a stage too. If the file `baseline` exists and was saved
+    with the same parameters, a stage is a regression when its time or the
+    growth of its peak memory exceeds the baseline by more than `tolerance`.
+    The results are saved to `baseline` if it does not exist or if
+    `update_baseline` is True.
+
+    Returns
+    -------
+    dict:
+        Results by stage: read_dat, read_csv, read_files,
+        calc_monthly_ret_and_vol, main and import project2.main
+    """
+    params = {'n_tickers': n_tickers, 'years': years, 'missing_rate': missing_rate,
+              'noise_rate': noise_rate}
+    with tempfile.TemporaryDirectory() as root, _datadir(root):
+        csv_tickers, dat_files = make_synthetic_datadir(
+            root, n_tickers, years, missing_rate=missing_rate, noise_rate=noise_rate)
+        dat_stats = _file_stats([os.path.join(root, dat) for dat in dat_files])
+        csv_stats = _file_stats([os.path.join(root, f'{tic.lower()}_prc.csv') for tic in csv_tickers])
+        all_stats = (dat_stats[0] + csv_stats[0], dat_stats[1] + csv_stats[1])
+        panel_rows = len(main.read_files(csv_tickers, dat_files))
+
+        stages = {
+            'read_dat': (measure(_stage_read_dat, root, dat_files), dat_stats),
+            'read_csv': (measure(_stage_read_csv, root, csv_tickers), csv_stats),
+            'read_files': (measure(_read_files_in, root, csv_tickers, dat_files), all_stats),
+            'calc_monthly_ret_and_vol': (
+                measure(main.calc_monthly_ret_and_vol, root, csv_tickers, dat_files,
+                        setup=_stage_calc_setup),
+                (panel_rows, None)),
+            'main': (measure(_stage_main, root, csv_tickers, dat_files), all_stats),
+            }
+    # Best of 3 new interpreters, to limit the noise
+    import_seconds = min(import_time('project2.main')[0] for _ in range(3))
+    stages['import project2.main'] = ({'seconds': import_seconds, 'peak_rss_mb': None,
+                                       'peak_rss_delta_mb': 0.0}, (0, None))
+
+    results = {}
+    for stage, (res, (rows, size)) in stages.items():
+        results[stage] = {
+            'seconds': res['seconds'],
+            'rows_per_s': rows / res['seconds'] if rows else None,
+            'mb_per_s': None if size is None else size / 2 ** 20 / res['seconds'],
+            'peak_rss_mb': res['peak_rss_mb'],
+            'peak_rss_delta_mb': res['peak_rss_delta_mb'],
+            }
+
+    saved = None
+    if baseline is not None and os.path.exists(baseline):
+        with open(baseline) as fobj:
+            saved = json.load(fobj)
+        if saved['params'] != params:
+            print(f'Baseline {baseline} was saved with other parameters: {saved["params"]}')
+            saved = None
+    if saved is not None:
+        for stage, res in results.items():
+            base = saved['stages'].get(stage)
+            if base is None:
+                continue
+            res['baseline_seconds'] = base['seconds']
+            res['change'] = res['seconds'] / base['seconds'] - 1
+            res['regression'] = (
+                res['seconds'] > base['seconds'] * (1 + tolerance)
+                or res['peak_rss_delta_mb'] > base['peak_rss_delta_mb'] * (1 + tolerance) + 1)
+
+    _print_results(f'pipeline: {n_tickers} synthetic tickers x {years} years, '
+                   f'{missing_rate:.0%} -99 rows, {noise_rate:.0%} noisy rows', results)
+    if baseline is not None and (update_baseline or not os.path.exists(baseline)):
+        tmp = f'{baseline}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fobj:
+            json.dump({'params': params, 'stages': results}, fobj, indent=2)
+        os.replace(tmp, baseline)
+        print(f'Baseline saved to {baseline}')
+    return results
+
+
+if __name__ == "__main__":
+    bench_read_dat()
+    bench_cache()
+    bench_clean_dat()
+    bench_merge_ticker()
+    bench_read_files_workers()
+    bench_iter_files_workers()
+    bench_monthly_volatility()
+    bench_calc_monthly_ret_and_vol()
+    bench_multi_price()
+    bench_shared()
+    bench_result_cache()
+    bench_month_keys()
+    bench_compact_dtypes()
+    bench_normalise()
+    bench_batch_ols()
+    bench_rolling_ols()
+    bench_store()
+    bench_exports()
+    bench_read_files_async()
+    bench_factor_alignment()
+    bench_import_time()
+    bench_pipeline()
@@ -0,0 +1,348 @@
+""" cache.py
+
+On-disk cache of the cleaned date/ticker/price frames read from the source
+files under cfg.DATADIR.
+
+Each entry is keyed by the fingerprint of its source file (path, mtime,
+size and content hash) together with the arguments that change the output
+(prc_col, ticker), so editing a source file never returns stale data.
+Entries are stored as Feather files when pyarrow is installed and as
+pickles otherwise.
+
+Results computed from frames (e.g. by calc_monthly_ret_and_vol) are
+memoized separately, keyed by the content hash of the input frame (see
+frame_hash), the name and version of the function and its arguments. They
+are held in memory, up to RESULTS_MAX_BYTES for the least recently used,
+and optionally also on disk under RESULTS_DIR, so that another run with the
+same inputs skips the computation.
+"""
+from __future__ import annotations
+
+import collections
+import functools
+import hashlib
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+
+from project2 import config as cfg
+
+
+CACHE_DIR = os.path.join(cfg.DATADIR, '.cache')
+
+# Least recently used entries are evicted beyond this total size
+CACHE_MAX_BYTES = 1 << 30
+
+# Part of every key, to be increased when the format of cached frames changes
+CACHE_VERSION = 4
+
+# pyarrow is only imported when the cache is used, see _feather
+EXT = '.feather' if importlib.util.find_spec('pyarrow') is not None else '.pkl'
+
+# Content hashes already computed in this process, by (path, mtime, size)
+_content_hashes = {}
+
+# Memoized results: total size in memory beyond which the least recently used
+# are dropped, and the folder of the on-disk tier
+RESULTS_MAX_BYTES = 256 << 20
+RESULTS_DIR = os.path.join(CACHE_DIR, 'results')
+
+# Pickles keep the dtypes of results exactly, and results are small
+RESULTS_EXT = '.pkl'
+
+# Entries of each cache folder known to this process, by (folder, ext), see
+# _dir_index
+_dir_indexes = {}
+
+
+####################
+# Helper Functions #
+####################
+@functools.cache
+def _feather():
+    # pyarrow.feather, or None if pyarrow is not installed
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        return None
+    return feather
+
+def _path_id(pth):
+    # Prefix shared by all entries of the source file `pth`
+    return hashlib.blake2b(os.path.abspath(pth).encode(), digest_size=8).hexdigest()
+
+def _content_hash(pth, stat):
+    key = (os.path.abspath(pth), stat.st_mtime_ns, stat.st_size)
+    if key not in _content_hashes:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(pth, 'rb') as fobj:
+            for block in iter(lambda: fobj.read(1 << 20), b''):
+                digest.update(block)
+        _content_hashes[key] = digest.hexdigest()
+    return _content_hashes[key]
+
+def _entries(cache_dir, ext=EXT):
+    if not os.path.isdir(cache_dir):
+        return []
+    return [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+            if name.endswith(ext)]
+
+def _frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+class _LRU:
+    # Frames by key, least recently used first, dropped beyond
+    # RESULTS_MAX_BYTES in total
+    def __init__(self):
+        self.frames = collections.OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key):
+        if key not in self.frames:
+            return None
+        self.frames.move_to_end(key)
+        return self.frames[key][0]
+
+    def put(self, key, df):
+        self.pop(key)
+        size = _frame_bytes(df)
+        if size > RESULTS_MAX_BYTES:
+            return
+        self.frames[key] = (df, size)
+        self.nbytes += size
+        while self.nbytes > RESULTS_MAX_BYTES:
+            _, (_, old_size) = self.frames.popitem(last=False)
+            self.nbytes -= old_size
+
+    def pop(self, key):
+        if key in self.frames:
+            self.nbytes -= self.frames.pop(key)[1]
+
+    def clear(self):
+        self.frames.clear()
+        self.nbytes = 0
+
+_results = _LRU()
+
+
+class _DirIndex:
+    # Sizes of the entries of a cache folder, least recently used first,
+    # with their running total. The folder is listed once per process, then
+    # the index is kept up to date by load and store, so that storing an
+    # entry does not rescan the folder. Entries written by other processes
+    # are only counted from the next listing.
+    def __init__(self, cache_dir, ext):
+        entries = sorted((os.stat(pth).st_mtime_ns, os.path.getsize(pth), pth)
+                         for pth in _entries(cache_dir, ext))
+        self.sizes = collections.OrderedDict((pth, size) for _, size, pth in entries)
+        self.nbytes = sum(self.sizes.values())
+
+    def touch(self, pth):
+        if pth in self.sizes:
+            self.sizes.move_to_end(pth)
+
+    def add(self, pth, max_bytes):
+        # Count the entry `pth` just written, then remove the least recently
+        # used entries until the total is no larger than `max_bytes`
+        self.nbytes -= self.sizes.pop(pth, 0)
+        self.sizes[pth] = os.path.getsize(pth)
+        self.nbytes += self.sizes[pth]
+        while self.nbytes > max_bytes and self.sizes:
+            old, size = self.sizes.popitem(last=False)
+            self.nbytes -= size
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                # Already evicted by another process
+                pass
+
+def _dir_index(cache_dir, ext):
+    key = (os.path.abspath(cache_dir), ext)
+    if key not in _dir_indexes:
+        _dir_indexes[key] = _DirIndex(cache_dir, ext)
+    return _dir_indexes[key]
+
+def _touch(pth, cache_dir, ext):
+    # Mark the entry `pth` as recently used for eviction
+    os.utime(pth)
+    index = _dir_indexes.get((os.path.abspath(cache_dir), ext))
+    if index is not None:
+        index.touch(pth)
+
+def _forget(cache_dir, ext):
+    # Drop the index of a folder whose entries were removed outside of it
+    _dir_indexes.pop((os.path.abspath(cache_dir), ext), None)
+
+
+##################
+# Core Functions #
+##################
+def fingerprint(pth, **params) -> str:
+    """ Returns the cache key of the source file `pth` read with `params`
+    (e.g. prc_col='adj_close', ticker='TSLA')
+
+    Parameters
+    ----------
+    pth: str
+        Location of the source file
+
+    params:
+        Arguments of the reader that change its output
+    """
+    stat = os.stat(pth)
+    parts = [str(CACHE_VERSION), os.path.abspath(pth), str(stat.st_mtime_ns),
+             str(stat.st_size), _content_hash(pth, stat)]
+    parts.extend(f'{k}={v}' for k, v in sorted(params.items()))
+    digest = hashlib.blake2b('\0'.join(parts).encode(), digest_size=16).hexdigest()
+    return f'{_path_id(pth)}-{digest}'
+
+
+def load(key: str, cache_dir: str = CACHE_DIR) -> pd.DataFrame | None:
+    """ Returns the frame stored under `key`, or None if there is none
+    """
+    pth = os.path.join(cache_dir, key + EXT)
+    if not os.path.exists(pth):
+        return None
+    _touch(pth, cache_dir, EXT)
+    feather = _feather()
+    if feather is not None:
+        return feather.read_feather(pth)
+    return pd.read_pickle(pth)
+
+
+def store(
+        key: str,
+        df: pd.DataFrame,
+        cache_dir: str = CACHE_DIR,
+        max_bytes: int = CACHE_MAX_BYTES,
+        ) -> None:
+    """ Store `df` under `key`, then evict old entries so that the cache
+    stays under `max_bytes`
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    pth = os.path.join(cache_dir, key + EXT)
+    # Write to a temporary name first so readers never see a partial entry
+    tmp = f'{pth}.{os.getpid()}.tmp'
+    feather = _feather()
+    if feather is not None:
+        feather.write_feather(df, tmp)
+    else:
+        df.to_pickle(tmp)
+    os.replace(tmp, pth)
+    _dir_index(cache_dir, EXT).add(pth, max_bytes)
+
+
+def evict(max_bytes: int = CACHE_MAX_BYTES, cache_dir: str = CACHE_DIR, ext: str = EXT) -> int:
+    """ Remove least recently used entries (files ending with `ext`) until
+    the cache is no larger than `max_bytes`. Returns the number of bytes
+    removed.
+    """
+    entries = sorted((os.stat(pth).st_mtime_ns, os.path.getsize(pth), pth)
+                     for pth in _entries(cache_dir, ext))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, pth in entries:
+        if total - removed <= max_bytes:
+            break
+        os.remove(pth)
+        removed += size
+    _forget(cache_dir, ext)
+    return removed
+
+
+def invalidate(pth=None, cache_dir: str = CACHE_DIR) -> int:
+    """ Remove the cache entries of the source file `pth`, or every entry
+    if `pth` is None. Returns the number of entries removed.
+    """
+    prefix = '' if pth is None else _path_id(pth) + '-'
+    entries = [e for e in _entries(cache_dir)
+               if os.path.basename(e).startswith(prefix)]
+    for entry in entries:
+        os.remove(entry)
+    _forget(cache_dir, EXT)
+    return len(entries)
+
+
+def cache_size(cache_dir: str = CACHE_DIR) -> int:
+    """ Total size in bytes of the entries in the cache
+    """
+    return sum(os.path.getsize(pth) for pth in _entries(cache_dir))
+
+
+def frame_hash(df: pd.DataFrame) -> str:
+    """ Content hash of the columns of `df`: their names, dtypes and values
+    (not the index). The underlying arrays are hashed as they are, and
+    categorical columns as their codes and categories.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(len(df)).encode())
+    for col in df.columns:
+        values = df[col]
+        digest.update(f'\0{col}\0{values.dtype}\0'.encode())
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            digest.update('\0'.join(map(str, values.cat.categories)).encode())
+            values = values.cat.codes
+        arr = values.to_numpy()
+        if arr.dtype.kind not in 'biufcmM':
+            # Strings and objects, hashed element-wise by pandas
+            arr = pd.util.hash_pandas_object(values, index=False).to_numpy()
+        digest.update(np.ascontiguousarray(arr).view(np.uint8))
+    return digest.hexdigest()
+
+
+def result_key(name: str, version, df: pd.DataFrame, **params) -> str:
+    """ Returns the key of the result of the function `name`, at `version`,
+    computed from the frame `df` with `params`
+    """
+    parts = [str(CACHE_VERSION), name, str(version), frame_hash(df)]
+    parts.extend(f'{k}={v}' for k, v in sorted(params.items()))
+    return hashlib.blake2b('\0'.join(parts).encode(), digest_size=16).hexdigest()
+
+
+def load_result(key: str, disk: bool = False) -> pd.DataFrame | None:
+    """ Returns the result memoized under `key`, from memory or, if `disk`,
+    from RESULTS_DIR, or None if there is none. Each call returns a new
+    frame, so changing it leaves the memoized result as it is.
+    """
+    df = _results.get(key)
+    if df is None and disk:
+        pth = os.path.join(RESULTS_DIR, key + RESULTS_EXT)
+        if not os.path.exists(pth):
+            return None
+        _touch(pth, RESULTS_DIR, RESULTS_EXT)
+        df = pd.read_pickle(pth)
+        _results.put(key, df)
+    return None if df is None else df.copy(deep=False)
+
+
+def store_result(
+        key: str,
+        df: pd.DataFrame,
+        disk: bool = False,
+        max_bytes: int = CACHE_MAX_BYTES,
+        ) -> None:
+    """ Memoize the result `df` under `key` in memory and, if `disk`, in
+    RESULTS_DIR, which is then kept under `max_bytes`
+    """
+    df = df.copy(deep=False)
+    _results.put(key, df)
+    if disk:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        pth = os.path.join(RESULTS_DIR, key + RESULTS_EXT)
+        tmp = f'{pth}.{os.getpid()}.tmp'
+        df.to_pickle(tmp)
+        os.replace(tmp, pth)
+        _dir_index(RESULTS_DIR, RESULTS_EXT).add(pth, max_bytes)
+
+
+def clear_results(disk: bool = False) -> None:
+    """ Forget the results memoized in memory, and those on disk if `disk`
+    """
+    _results.clear()
+    if disk:
+        for pth in _entries(RESULTS_DIR, RESULTS_EXT):
+            os.remove(pth)
+        _forget(RESULTS_DIR, RESULTS_EXT)
@@ -0,0 +1,175 @@
+""" factors.py
+
+Fama-French factors of ff_daily.csv on the monthly grid of
+calc_monthly_ret_and_vol, and regressions of monthly excess returns on
+lagged volatility and the factors.
+
+The daily file is parsed and compounded to months once per process (and
+again only if the file changes). Months are then looked up by position in
+dense arrays indexed by the integer month key of main.month_key, so adding
+the factors to the monthly data of any number of tickers is a single array
+lookup rather than a pd.merge per ticker.
+
+Example
+-------
+>> monthly_data = calc_monthly_ret_and_vol(read_files(...), mdate_str=False)
+>> factors.factor_regression(monthly_data)
+"""
+from __future__ import annotations
+
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+from project2 import config as cfg
+from project2 import main
+from project2 import ols
+
+
+# Factor columns, as named by rename_cols
+FACTORS = ['mkt_rf', 'smb', 'hml', 'rf']
+
+FF_FILE = 'ff_daily.csv'
+
+
+####################
+# Helper Functions #
+####################
+def _month_keys(mdate):
+    # Integer month keys of a column of keys or of YYYY-MM strings
+    mdate = pd.Series(mdate)
+    if not pd.api.types.is_integer_dtype(mdate):
+        mdate = mdate.astype(str)
+        mdate = mdate.str[:4].astype(int) * 12 + mdate.str[5:7].astype(int)
+    return mdate.to_numpy(dtype=np.int64)
+
+@functools.lru_cache(maxsize=8)
+def _load(pth, mtime_ns, size):
+    # Monthly factors of the file `pth`. mtime_ns and size are part of the
+    # memoization key, so an edited file is read again.
+    daily = pd.read_csv(pth)
+    main.rename_cols(daily)
+    months = main.month_key(pd.to_datetime(daily['date'], format='ISO8601'))
+    return MonthlyFactors(months, daily[FACTORS].to_numpy(dtype=float))
+
+
+##################
+# Core Functions #
+##################
+class MonthlyFactors:
+    """ Compounded monthly returns of the factors, (1 + r_1)...(1 + r_n) - 1
+    over the days of each month, in a dense array with one row per month
+    from the first to the last month of the file
+    """
+    def __init__(self, months, daily_values):
+        self.first = int(months.min())
+        n_months = int(months.max()) - self.first + 1
+        pos = months - self.first
+        # Sum of log(1 + r) by month, exponentiated back once
+        log_sums = np.zeros((n_months, daily_values.shape[1]))
+        for j in range(daily_values.shape[1]):
+            log_sums[:, j] = np.bincount(pos, weights=np.log1p(daily_values[:, j]), minlength=n_months)
+        self.values = np.expm1(log_sums)
+        self.values[np.bincount(pos, minlength=n_months) == 0] = np.nan
+
+    def lookup(self, mdate) -> np.ndarray:
+        """ Factors (rows x FACTORS) of the months `mdate`, integer keys or
+        YYYY-MM strings. Months outside of the file are NaN.
+        """
+        pos = _month_keys(mdate) - self.first
+        inside = (pos >= 0) & (pos < len(self.values))
+        out = np.full((len(pos), self.values.shape[1]), np.nan)
+        out[inside] = self.values[pos[inside]]
+        return out
+
+    def to_frame(self, mdate_str: bool = True) -> pd.DataFrame:
+        """ Monthly factors as a frame with columns mdate and FACTORS
+        """
+        df = pd.DataFrame(self.values, columns=FACTORS)
+        df.insert(0, 'mdate', np.arange(self.first, self.first + len(df)))
+        df = df.dropna().reset_index(drop=True)
+        if mdate_str:
+            df['mdate'] = main.month_str(df['mdate'])
+        return df
+
+
+def monthly_factors(pth=None) -> MonthlyFactors:
+    """ Monthly factors of ff_daily.csv (or of the file `pth`), parsed on
+    the first call and memoized
+    """
+    if pth is None:
+        pth = os.path.join(cfg.DATADIR, FF_FILE)
+    stat = os.stat(pth)
+    return _load(os.path.abspath(pth), stat.st_mtime_ns, stat.st_size)
+
+
+def add_factors(monthly_data: pd.DataFrame, pth=None) -> pd.DataFrame:
+    """ Returns `monthly_data` (as returned by calc_monthly_ret_and_vol) with
+    the columns of FACTORS for its month and the excess return
+    exret = mret - rf
+    """
+    values = monthly_factors(pth).lookup(monthly_data['mdate'])
+    exret = monthly_data['mret'].to_numpy(dtype=float) - values[:, FACTORS.index('rf')]
+    # One block of new columns, rather than inserting them one at a time
+    added = pd.DataFrame(np.column_stack([values, exret]), columns=FACTORS + ['exret'],
+                         index=monthly_data.index)
+    monthly_data = monthly_data.drop(columns=added.columns, errors='ignore')
+    return pd.concat([monthly_data, added], axis=1)
+
+
+def factor_regression(
+        monthly_data: pd.DataFrame,
+        by: str | None = None,
+        pth=None,
+        ) -> pd.DataFrame:
+    """ Regress the excess return mret - rf on lagged_mvol, mkt_rf, smb and
+    hml, pooled across tickers or for every group of `by` (e.g. 'ticker')
+
+    Parameters
+    ----------
+    monthly_data: frame
+        As returned by calc_monthly_ret_and_vol, with mdate as integer keys
+        or YYYY-MM strings. lagged_mvol is computed by ticker if missing.
+
+    by: str, optional
+        Columns defining separate regressions, see ols.batch_ols
+
+    pth: str, optional
+        Location of the daily factors, ff_daily.csv by default
+
+    Returns
+    -------
+    frame:
+        The output of ols.batch_ols
+    """
+    if 'lagged_mvol' not in monthly_data:
+        monthly_data = monthly_data.sort_values(by=['ticker', 'mdate'])
+        monthly_data = monthly_data.assign(
+            lagged_mvol=monthly_data.groupby('ticker', observed=True)['mvol'].shift(1))
+    data = add_factors(monthly_data, pth)
+    return ols.batch_ols(data, 'exret', ['lagged_mvol', 'mkt_rf', 'smb', 'hml'], by=by)
+
+
+def main_factors(
+        csv_tickers: list | None = None,
+        dat_files: list | None = None,
+        prc_col: str = 'adj_close',
+        ):
+    """ Same as main, regressing the excess monthly return on lagged monthly
+    volatility and the Fama-French factors:
+
+        mret - rf = intercept + a * lagged_mvol + b * mkt_rf + c * smb + d * hml + error
+
+    Prints the summary of the statsmodels fit.
+    """
+    import statsmodels.formula.api as smf
+
+    chunks = main.iter_files(csv_tickers=csv_tickers, dat_files=dat_files, prc_col=prc_col)
+    monthly_data = main.calc_monthly_ret_and_vol(chunks, mdate_str=False)
+    monthly_data['lagged_mvol'] = monthly_data.groupby('ticker', observed=True)['mvol'].shift(1)
+    data = add_factors(monthly_data).dropna()
+
+    regression_model = smf.ols(formula='exret ~ lagged_mvol + mkt_rf + smb + hml', data=data).fit()
+    print(regression_model.summary())
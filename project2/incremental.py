@@ -0,0 +1,165 @@
+""" incremental.py
+
+Incremental version of calc_monthly_ret_and_vol. A state holds, for each
+ticker, what is needed to extend its daily and monthly series: the last
+daily price, the running count, sum and sum of squares of dret in the open
+month, the closing price of the open month so far and of the previous
+month. New daily rows then only update the months they fall in, and the
+monthly results of earlier months are kept as they are.
+
+Example
+-------
+>> state = incremental.update(incremental.empty_state(), read_files(...))
+>> state = incremental.update(state, new_daily_rows)
+>> incremental.save_state(state, pth)
+>> incremental.monthly_results(state)
+"""
+from __future__ import annotations
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from project2 import main
+
+
+STATE_COLS = ['ticker', 'last_date', 'last_price', 'month', 'n', 's', 'ss',
+              'month_close', 'prev_close']
+
+
+####################
+# Helper Functions #
+####################
+def _mvol(n, s, ss):
+    # Population standard deviation of dret * sqrt(21) from the running sums
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s / n
+        var = np.maximum(ss / n - mean * mean, 0)
+    return np.where(n > 0, np.sqrt(var) * np.sqrt(21), np.nan)
+
+
+##################
+# Core Functions #
+##################
+def empty_state() -> dict:
+    """ State without any ticker, to be passed to update with the full
+    history
+    """
+    tickers = pd.DataFrame({col: pd.Series(dtype=float) for col in STATE_COLS})
+    tickers = tickers.astype({'ticker': object, 'last_date': 'datetime64[ns]', 'month': np.int64,
+                              'n': np.int64})
+    monthly = pd.DataFrame({'mdate': pd.Series(dtype=np.int64), 'ticker': pd.Series(dtype=object),
+                            'mret': pd.Series(dtype=float), 'mvol': pd.Series(dtype=float)})
+    return {'tickers': tickers, 'monthly': monthly}
+
+
+def update(state: dict, df: pd.DataFrame) -> dict:
+    """ Returns the state updated with the new daily rows `df`.
+
+    Parameters
+    ----------
+    state: dict
+        From empty_state, load_state or a previous update
+
+    df: frame
+        New daily rows with columns date, ticker and price. Rows that are
+        not after the last date of their ticker in `state` are ignored.
+
+    Returns
+    -------
+    dict:
+        The new state. Only the months of the new rows are recomputed in
+        its monthly results.
+    """
+    st = state['tickers'].set_index('ticker')
+    new = main.format_data_calc(df[['date', 'ticker', 'price']].copy())
+    new['ticker'] = new['ticker'].astype(str)
+    new['price'] = pd.to_numeric(new['price'], errors='coerce').astype(float)
+    new = new[new['date'].notna()]
+    last_date = st['last_date'].reindex(new['ticker'].to_numpy()).to_numpy()
+    new = new[pd.isna(last_date) | (new['date'].to_numpy() > last_date)]
+    if new.empty:
+        return state
+
+    # Daily returns, continuing from the last price of each known ticker
+    known = st.loc[st.index.isin(new['ticker'].unique())]
+    seeds = pd.DataFrame({'date': known['last_date'], 'ticker': known.index,
+                          'price': known['last_price'], 'seed': True})
+    new['seed'] = False
+    daily = main.compute_daily_returns(pd.concat([seeds, new], ignore_index=True))
+    daily = daily[~daily['seed']]
+    daily['mdate'] = main.month_key(daily['date']).astype(np.int64)
+    daily['dret2'] = daily['dret'] ** 2
+
+    # Running sums and closing price of every month touched by the new rows
+    agg = daily.groupby(['ticker', 'mdate']).agg(
+        n=('dret', 'count'), s=('dret', 'sum'), ss=('dret2', 'sum'), close=('price', 'last'),
+        ).reset_index()
+    agg_st = st.reindex(agg['ticker'])
+    in_open = (agg_st['month'].to_numpy() == agg['mdate'].to_numpy())
+    agg.loc[in_open, 'n'] += agg_st['n'].to_numpy()[in_open]
+    agg.loc[in_open, 's'] += agg_st['s'].to_numpy()[in_open]
+    agg.loc[in_open, 'ss'] += agg_st['ss'].to_numpy()[in_open]
+    agg['close'] = agg['close'].where(agg['close'].notna() | ~in_open,
+                                      agg_st['month_close'].to_numpy())
+
+    # The previous close of the first month of a ticker comes from the state
+    agg['prev_close'] = agg.groupby('ticker')['close'].shift(1)
+    first = ~agg['ticker'].duplicated()
+    from_state = np.where(in_open, agg_st['prev_close'], agg_st['month_close'])
+    agg.loc[first, 'prev_close'] = from_state[first.to_numpy()]
+
+    agg['mret'] = agg['close'] / agg['prev_close'] - 1
+    agg['mvol'] = _mvol(agg['n'].to_numpy(), agg['s'].to_numpy(), agg['ss'].to_numpy())
+
+    # Replace the results of the months that were recomputed
+    monthly = state['monthly']
+    touched = pd.MultiIndex.from_frame(agg[['ticker', 'mdate']])
+    keep = ~pd.MultiIndex.from_frame(monthly[['ticker', 'mdate']]).isin(touched)
+    monthly = pd.concat([monthly[keep], agg[['mdate', 'ticker', 'mret', 'mvol']].dropna()],
+                        ignore_index=True)
+    monthly = monthly.sort_values(by=['ticker', 'mdate'], ignore_index=True)
+
+    # New state of the updated tickers
+    last_month = agg.groupby('ticker').tail(1).set_index('ticker')
+    last_day = daily.groupby('ticker').tail(1).set_index('ticker')
+    updated = pd.DataFrame({
+        'last_date': last_day['date'],
+        'last_price': last_day['price'],
+        'month': last_month['mdate'],
+        'n': last_month['n'],
+        's': last_month['s'],
+        'ss': last_month['ss'],
+        'month_close': last_month['close'],
+        'prev_close': last_month['prev_close'],
+        })
+    st = pd.concat([st[~st.index.isin(updated.index)], updated]).sort_index()
+    return {'tickers': st.rename_axis('ticker').reset_index()[STATE_COLS], 'monthly': monthly}
+
+
+def monthly_results(state: dict, mdate_str: bool = True) -> pd.DataFrame:
+    """ Monthly results of `state`, with the columns of
+    calc_monthly_ret_and_vol
+    """
+    monthly = state['monthly'].copy()
+    if mdate_str:
+        monthly['mdate'] = main.month_str(monthly['mdate'])
+    return monthly[['mdate', 'ticker', 'mret', 'mvol']]
+
+
+def save_state(state: dict, pth) -> None:
+    """ Write `state` to the file `pth`, replacing it atomically
+    """
+    tmp = f'{pth}.{os.getpid()}.tmp'
+    pd.to_pickle(state, tmp)
+    os.replace(tmp, pth)
+
+
+def load_state(pth) -> dict:
+    """ Read a state written by save_state, or an empty state if `pth` does
+    not exist
+    """
+    if not os.path.exists(pth):
+        return empty_state()
+    return pd.read_pickle(pth)
@@ -0,0 +1,243 @@
+""" instrument.py
+
+Opt-in instrumentation of the stages of the pipeline: read_files,
+iter_files, read_csv, read_dat, merge_ticker (merging the frames of a
+ticker), format_data_calc, compute_daily_returns, compute_monthly_data and
+fit. main reads through iter_files, so read_files only appears for callers
+of read_files.
+
+Outside of `record`, an instrumented stage costs a single check. Inside,
+every call of a stage adds its wall time, rows in and out and the change
+of the resident set size to the report. Times of nested stages are
+included in the stage calling them, e.g. read_csv in iter_files. A
+generator stage such as iter_files counts only the time spent producing
+its items, not the time its caller spends on them.
+
+Example
+-------
+>> with instrument.record(cprofile_dir='profiles') as report:
+>>     main.main(['tsla'], ['data1.dat'])
+>> report.to_dict()
+>> report.to_json('report.json')
+"""
+from __future__ import annotations
+
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import pstats
+import resource
+import time
+
+import pandas as pd
+
+
+# Report being recorded, if any
+_active = None
+
+# Returned by next once a generator stage is exhausted
+_DONE = object()
+
+# Size of a memory page, for the resident set size in /proc/self/statm
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+####################
+# Helper Functions #
+####################
+def _rss_mb():
+    # Current resident set size in MB, or the peak where /proc is missing
+    try:
+        with open('/proc/self/statm') as fobj:
+            return int(fobj.read().split()[1]) * _PAGE_SIZE / 2 ** 20
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _rows(obj):
+    # Number of rows of a frame, None for anything else
+    return len(obj) if isinstance(obj, (pd.DataFrame, pd.Series)) else None
+
+def _iter_stage(report, name, items):
+    # Yields the items of the generator `items`, recording the time and
+    # memory spent producing them as one call of the stage `name`
+    profile = None
+    if report.cprofile_dir is not None and not report._profiling:
+        profile = cProfile.Profile()
+    seconds, rss_delta_mb, rows_out = 0.0, 0.0, 0
+    try:
+        while True:
+            # The caller may profile its own stages between items
+            profiling = profile is not None and not report._profiling
+            rss0 = _rss_mb()
+            start = time.perf_counter()
+            if profiling:
+                report._profiling = True
+                profile.enable()
+            try:
+                item = next(items, _DONE)
+            finally:
+                if profiling:
+                    profile.disable()
+                    report._profiling = False
+                seconds += time.perf_counter() - start
+                rss_delta_mb += _rss_mb() - rss0
+            if item is _DONE:
+                return
+            rows_out += _rows(item) or 0
+            yield item
+    finally:
+        items.close()
+        if profile is not None:
+            report._add_profile(name, profile)
+        report.add(name, seconds, None, rows_out, rss_delta_mb)
+
+
+##################
+# Core Functions #
+##################
+class Report:
+    """ Statistics of the stages called while it is recorded, by stage
+    """
+    def __init__(self, cprofile_dir=None):
+        self.cprofile_dir = cprofile_dir
+        self.stages = {}
+        self._profiles = {}
+        self._profiling = False
+
+    def add(self, name, seconds, rows_in, rows_out, rss_delta_mb):
+        stats = self.stages.setdefault(name, {
+            'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0,
+            'rss_delta_mb': 0.0, 'max_rss_delta_mb': 0.0})
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['rows_in'] += rows_in or 0
+        stats['rows_out'] += rows_out or 0
+        stats['rss_delta_mb'] += rss_delta_mb
+        stats['max_rss_delta_mb'] = max(stats['max_rss_delta_mb'], rss_delta_mb)
+
+    def to_dict(self) -> dict:
+        """ Statistics by stage: calls, seconds, rows_in, rows_out,
+        rss_delta_mb (total) and max_rss_delta_mb (largest of one call)
+        """
+        return {name: dict(stats) for name, stats in self.stages.items()}
+
+    def to_json(self, pth=None) -> str:
+        """ The report as a JSON string, also written to `pth` if given
+        """
+        text = json.dumps(self.to_dict(), indent=2)
+        if pth is not None:
+            with open(pth, 'w') as fobj:
+                fobj.write(text)
+        return text
+
+    def dump_profiles(self, cprofile_dir) -> list:
+        """ Write the cProfile statistics of each stage to
+        `cprofile_dir`/<stage>.prof, readable with pstats or snakeviz.
+        Returns the files written.
+        """
+        os.makedirs(cprofile_dir, exist_ok=True)
+        pths = []
+        for name, stats in self._profiles.items():
+            pth = os.path.join(cprofile_dir, f'{name}.prof')
+            stats.dump_stats(pth)
+            pths.append(pth)
+        return pths
+
+    def _add_profile(self, name, profile):
+        if name in self._profiles:
+            self._profiles[name].add(profile)
+        else:
+            self._profiles[name] = pstats.Stats(profile)
+
+
+@contextlib.contextmanager
+def record(cprofile_dir=None):
+    """ Record the stages called in the block into the Report it yields.
+
+    Parameters
+    ----------
+    cprofile_dir: str, optional
+        If given, stages are also run under cProfile and the statistics of
+        each stage are written to <cprofile_dir>/<stage>.prof at the end
+        of the block. Only one profiler runs at a time, so a stage called by
+        another stage is profiled as part of the outer one.
+    """
+    global _active
+    previous, _active = _active, Report(cprofile_dir)
+    report = _active
+    try:
+        yield report
+    finally:
+        _active = previous
+        if cprofile_dir is not None:
+            report.dump_profiles(cprofile_dir)
+
+
+@contextlib.contextmanager
+def stage(name: str, rows_in: int | None = None):
+    """ Record the block as a call of the stage `name`. The dict it yields
+    takes the number of rows out under 'rows_out', and drops the call if
+    'skip' is set to True.
+    """
+    report = _active
+    rec = {'rows_out': None, 'skip': False}
+    if report is None:
+        yield rec
+        return
+
+    profile = None
+    if report.cprofile_dir is not None and not report._profiling:
+        profile = cProfile.Profile()
+        report._profiling = True
+    rss0 = _rss_mb()
+    start = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield rec
+    finally:
+        if profile is not None:
+            profile.disable()
+            report._profiling = False
+            report._add_profile(name, profile)
+        if not rec['skip']:
+            report.add(name, time.perf_counter() - start, rows_in, rec['rows_out'],
+                       _rss_mb() - rss0)
+
+
+def instrumented(name: str):
+    """ Decorator recording each call of a function as a call of the stage
+    `name`. Rows in are those of the first frame argument, rows out those
+    of the returned frame.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            rows_in = next((_rows(arg) for arg in args if _rows(arg) is not None), None)
+            with stage(name, rows_in) as rec:
+                result = func(*args, **kwargs)
+                rec['rows_out'] = _rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def instrumented_iter(name: str):
+    """ Decorator recording each iteration of a generator function as a call
+    of the stage `name`, once the generator is exhausted or closed. Only the
+    time spent producing the items is counted. Rows out are those of the
+    frames yielded.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            return _iter_stage(_active, name, func(*args, **kwargs))
+        return wrapper
+    return decorator
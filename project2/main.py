@@ -2,21 +2,58 @@
 """
 from __future__ import annotations
 
+import collections
+import contextlib
+import csv
+import functools
+import io
+import json
 import os
+import pickle
+import re
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
-import statsmodels.formula.api as smf
 
 
+from project2 import cache
 from project2 import config as cfg
+from project2 import instrument
+from project2 import ols
 from project2 import util
 
 
 ####################
 # Helper Functions #
 ####################
+# Number of distinct column names and headers remembered by normalise and
+# normalise_header
+NORMALISE_CACHE_SIZE = 4096
+
+# Upper case letters other than the first character, and runs of
+# non-alphanumeric characters
+_CAMEL_RE = re.compile(r'(?<=.)([A-Z])', re.DOTALL)
+_NON_ALNUM_RE = re.compile(r'[^a-z0-9]+')
+
+def _normalise_chars(name):
+    # Character by character version of normalise, which handles non-ASCII
+    # names the same way as str.isupper/str.isalnum
+
+    # Convert Camel to Snake Case
+    cased_name = ''.join('_' + ch.lower() if ch.isupper() and i != 0 else ch.lower()
+                         for i, ch in enumerate(name))
+
+    # Replace alphanumerics with underscores
+    new = ''.join(ch if ch.isalnum() else '_' for ch in cased_name)
+
+    # Replace many underscores with single one
+    return re.sub('_+', '_', new)
+
+@functools.lru_cache(maxsize=NORMALISE_CACHE_SIZE)
 def normalise(name):
     # Remove leading and trailing whitespaces
     name = name.strip()
@@ -24,56 +61,631 @@ def normalise(name):
     if name.isupper():
         name = name.lower()
 
+    if not name.isascii():
+        return _normalise_chars(name)
 
-    # Convert Camel to Snake Case
-    cased_name = ''
-    for i, ch in enumerate(name):
-        if ch.isupper() and i != 0:
-            cased_name += '_' + ch.lower()
-        else:
-            cased_name += ch.lower()
+    # Convert Camel to Snake Case, then replace runs of non-alphanumerics
+    # (underscores included) with a single underscore
+    return _NON_ALNUM_RE.sub('_', _CAMEL_RE.sub(r'_\1', name).lower())
 
-    # Replace alphanumerics with underscores
-    new = ''
-    for ch in cased_name:
-        if ch.isalnum():
-            new += ch
-        else:
-            new += '_'
+@functools.lru_cache(maxsize=NORMALISE_CACHE_SIZE)
+def normalise_header(columns):
+    # Normalised names of the tuple of column names `columns`. Files sharing
+    # the same header line skip normalisation entirely.
+    return tuple(normalise(col) for col in columns)
+
+# Number of characters read from a .dat file at a time by _DatStream
+DAT_CHUNK_SIZE = 1 << 20
+
+# Number of rows of a .dat file parsed at a time by iter_files
+DAT_CHUNK_ROWS = 500_000
+
+# dtype of the price column of the frames returned by the read functions.
+# np.float32 halves its size at the cost of precision.
+PRICE_DTYPE = np.float64
+
+# Version of the results of calc_monthly_ret_and_vol, part of the key of its
+# memoized results. To be increased when its results change.
+CALC_VERSION = 1
+
+
+def _normalise_dat_lines(text):
+    # Tickers lose their quotations and every run of white space becomes a
+    # single comma, the same as a line of comma_dat.csv used to be written
+    lines = text.replace("'", "").split('\n')
+    return '\n'.join(','.join(line.split()).replace(',,', ',') for line in lines)
+
+
+def _is_path(pth):
+    # Whether `pth` is the location of a file rather than an open buffer
+    return isinstance(pth, (str, os.PathLike))
 
-    # Replace many underscores with single one
-    final = ''
-    prev = None
-    for ch in new:
-        if ch == '_' and prev == '_':
-            continue
-        final += ch
-        prev = ch
 
-    return final
+class _DatStream(io.TextIOBase):
+    """ Read-only text stream over the .dat file `pth` which yields the
+    comma separated version of its contents, `chunk_size` characters of the
+    source at a time. Passing it to pd.read_csv parses the file without
+    writing an intermediate copy to disk.
 
+    `pth` may also be an open binary or text buffer, e.g. io.BytesIO.
+    """
+    def __init__(self, pth, chunk_size: int = DAT_CHUNK_SIZE):
+        super().__init__()
+        if not _is_path(pth):
+            self._file = pth if isinstance(pth, io.TextIOBase) else io.TextIOWrapper(pth)
+        else:
+            self._file = open(pth, 'r') if os.path.exists(pth) else None
+        self._chunk_size = chunk_size
+        self._partial = ''
+        self._buf = ''
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        # Normalise the next chunk of complete lines, keeping any trailing
+        # partial line for the following chunk. Returns False at the end.
+        if self._file is None:
+            return False
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self._file.close()
+            self._file = None
+            if self._partial:
+                self._buf += _normalise_dat_lines(self._partial) + '\n'
+                self._partial = ''
+            return True
+        self.bytes_read += len(chunk)
+        text = self._partial + chunk
+        end = text.rfind('\n')
+        if end == -1:
+            self._partial = text
+        else:
+            self._partial = text[end + 1:]
+            self._buf += _normalise_dat_lines(text[:end]) + '\n'
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+        else:
+            while len(self._buf) < size and self._fill():
+                pass
+            if len(self._buf) > size:
+                out, self._buf = self._buf[:size], self._buf[size:]
+                return out
+        out, self._buf = self._buf, ''
+        return out
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super().close()
+
+
+# Extension of the sidecar index written next to a .dat file, see _dat_index
+DAT_INDEX_EXT = '.idx'
+
+# Part of every index, to be increased when the format of the blocks changes
+DAT_INDEX_VERSION = 2
+
+_ISO_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}$')
+
+def _dat_fields(line):
+    # Fields of a line of a .dat file, as pandas reads them
+    return next(csv.reader([_normalise_dat_lines(line.decode().rstrip('\r\n'))]), [])
+
+def _build_dat_index(pth):
+    # Blocks of consecutive lines of the same ticker in the .dat file `pth`:
+    # [ticker, first byte, end byte, first date, last date]. Dates are ISO
+    # strings, or None if a line of the block has a date in another format.
+    # Returns None if the header has no ticker or no date column.
+    blocks = []
+    with open(pth, 'rb') as fobj:
+        header = fobj.readline()
+        columns = normalise_header(tuple(_dat_fields(header)))
+        if 'ticker' not in columns or 'date' not in columns:
+            return None
+        tic_pos, date_pos = columns.index('ticker'), columns.index('date')
+        pos = len(header)
+        for line in fobj:
+            end = pos + len(line)
+            fields = _dat_fields(line)
+            tic = fields[tic_pos] if len(fields) > tic_pos else ''
+            date = fields[date_pos] if len(fields) > date_pos else ''
+            if blocks and (tic == blocks[-1][0] or not tic):
+                # Same ticker, or a blank line which the parser skips
+                block = blocks[-1]
+                block[2] = end
+            else:
+                block = [tic, pos, end, date, date]
+                blocks.append(block)
+            if tic and block[3] is not None:
+                if _ISO_DATE_RE.match(date):
+                    block[3], block[4] = min(block[3], date), max(block[4], date)
+                else:
+                    block[3] = block[4] = None
+            pos = end
+    return blocks
+
+def _dat_index(pth):
+    # Sidecar index of the .dat file `pth`, built on first use and rebuilt
+    # whenever the file changes. None if the file cannot be indexed.
+    stat = os.stat(pth)
+    idx_pth = pth + DAT_INDEX_EXT
+    if os.path.exists(idx_pth):
+        with open(idx_pth) as fobj:
+            index = json.load(fobj)
+        if (index.get('version') == DAT_INDEX_VERSION and index['size'] == stat.st_size
+                and index['mtime_ns'] == stat.st_mtime_ns):
+            return index['blocks']
+
+    blocks = _build_dat_index(pth)
+    index = {'version': DAT_INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'blocks': blocks}
+    tmp = f'{idx_pth}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'w') as fobj:
+            json.dump(index, fobj)
+        os.replace(tmp, idx_pth)
+    except OSError:
+        # A read-only folder only costs rebuilding the index next time
+        pass
+    return blocks
+
+def _select_dat_blocks(blocks, tickers=None, start=None, end=None):
+    # Byte ranges of the blocks which may hold rows of `tickers` between the
+    # ISO dates `start` and `end`, with adjacent ranges merged
+    ranges = []
+    for tic, first, last, min_date, max_date in blocks:
+        if tickers is not None and tic.upper() not in tickers:
+            continue
+        if min_date is not None and ((start is not None and max_date < start)
+                                     or (end is not None and min_date > end)):
+            continue
+        if ranges and ranges[-1][1] == first:
+            ranges[-1][1] = last
+        else:
+            ranges.append([first, last])
+    return ranges
+
+def _read_dat_ranges(pth, ranges):
+    # Parse the header of the .dat file `pth` and the byte `ranges` only
+    with open(pth, 'rb') as fobj:
+        parts = [fobj.readline()]
+        for first, last in ranges:
+            fobj.seek(first)
+            parts.append(fobj.read(last - first))
+    return pd.read_csv(io.StringIO(_normalise_dat_lines(b''.join(parts).decode())))
+
+def ticker_dtype(tickers=()):
+    # Categorical dtype of the ticker column: cfg.TICKERS plus any other
+    # `tickers`, sorted so that sorting by ticker stays alphabetical
+    return pd.CategoricalDtype(sorted(set(cfg.TICKERS).union(tickers)))
+
+def price_cols(prc_col='adj_close'):
+    """ Price columns of the frames read with `prc_col`: ['price'] for a
+    single column, the columns themselves for a list of columns
+    """
+    return ['price'] if isinstance(prc_col, str) else list(prc_col)
+
+def _rename_price(df, prc_col):
+    # `df` with its column `prc_col` renamed to price, replacing the price
+    # column of a file that has one (e.g. trf.dat read with prc_col='close')
+    if prc_col != 'price':
+        df = df.drop(columns='price', errors='ignore')
+    return df.rename(columns={prc_col: 'price'})
+
+def to_canonical(df, prc_cols=('price',)):
+    # date/ticker/price frame with the compact dtypes returned by the read
+    # functions: datetime64 date (invalid dates become NaT), categorical
+    # ticker and PRICE_DTYPE price, or PRICE_DTYPE columns `prc_cols`
+    ticker = df['ticker']
+    if isinstance(ticker.dtype, pd.CategoricalDtype):
+        tickers = ticker.cat.remove_unused_categories().cat.categories
+    else:
+        tickers = ticker.dropna().unique()
+    data = {
+        'date': pd.to_datetime(df['date'], format='ISO8601', errors='coerce'),
+        'ticker': ticker.astype(ticker_dtype(tickers)),
+        }
+    for col in prc_cols:
+        # As for a single prc_col, a file that already has a price column
+        # (e.g. trf.dat) gives it for any column it does not have
+        values = df[col] if col in df.columns or 'price' not in df.columns else df['price']
+        data[col] = pd.to_numeric(values, errors='coerce').astype(PRICE_DTYPE)
+    return pd.DataFrame(data, index=df.index)
+
+def _concat_canonical(frames):
+    # Concatenate canonical frames, unifying the ticker categories first so
+    # that the result stays categorical
+    dtype = ticker_dtype(set().union(*(df['ticker'].cat.categories for df in frames)))
+    return pd.concat([df.astype({'ticker': dtype}) for df in frames], ignore_index=True)
+
+def memory_report(df):
+    """ Returns the number of rows of `df` and the bytes used by its index,
+    each column and in total
+    """
+    usage = df.memory_usage(deep=True)
+    report = {'rows': len(df)}
+    report.update({str(k): int(v) for k, v in usage.items()})
+    report['total'] = int(usage.sum())
+    return report
+
+def new_run_dir(root=None):
+    """ Returns a new, empty folder for the files exported by one run, under
+    `root` (cfg.DATADIR/runs by default). Concurrent runs each get their own.
+    """
+    if root is None:
+        root = os.path.join(cfg.DATADIR, 'runs')
+    os.makedirs(root, exist_ok=True)
+    return tempfile.mkdtemp(prefix=time.strftime('%Y%m%d-%H%M%S-'), dir=root)
+
+def export_csv(df, export_dir, name):
+    """ Write `df` to the CSV file `name` in the folder `export_dir`,
+    replacing it atomically, and return its location
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    pth = os.path.join(export_dir, name)
+    # Write to a temporary name first so readers never see a partial file
+    tmp = f'{pth}.{os.getpid()}.tmp'
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, pth)
+    return pth
+
+# Cleaning rules of the .dat files by column, with normalised names (before
+# prc_col is renamed to price):
+#   missing: values meaning that the value is missing, like NaN
+#   negative: 'abs' to flip the sign of negative values, 'drop' to drop
+#       their rows, None to keep them
+# Rows with a missing value in any column are dropped. Numeric columns
+# without a rule use DAT_DEFAULT_RULE, other columns without a rule are
+# only missing where they are NA.
+DAT_DEFAULT_RULE = {'missing': (-99,), 'negative': None}
+DAT_CLEAN_RULES = {
+    # Negative open prices are consistent with the other prices once positive
+    'open': {'missing': (-99,), 'negative': 'abs'},
+    'close': {'missing': (-99,), 'negative': 'drop'},
+    'high': {'missing': (-99,), 'negative': 'drop'},
+    'low': {'missing': (-99,), 'negative': 'drop'},
+    'adj_close': {'missing': (-99,), 'negative': 'drop'},
+    'volume': {'missing': (-99,), 'negative': 'drop'},
+    }
+
+# Columns of the report of clean_dat
+CLEAN_REPORT_COLS = ['rows_in', 'dropped_missing', 'dropped_negative', 'dropped_duplicate',
+                     'fixed_negative', 'fixed_order', 'rows_out']
+
+def clean_dat(df, prc_col='adj_close', rules=None, drop_duplicates=True):
+    """ Clean the rows of a .dat file, as parsed by pd.read_csv, in one pass
+    of masks over its columns followed by a single selection of the rows
+    to keep, in ticker and date order. Rows are:
+
+        dropped if a value is missing (NaN or a `missing` value of its rule)
+        dropped if a value is negative and its rule is 'drop'
+        fixed if a value is negative and its rule is 'abs'
+        dropped if they repeat the ticker and date of an earlier row, if
+            `drop_duplicates`
+        reordered if they come before an earlier date of their ticker
+
+    Returns the clean frame, with normalised column names and prc_col
+    renamed to price (unless it is a list of columns), and a frame of the
+    number of rows of each ticker in each of these cases
+    (CLEAN_REPORT_COLS), indexed by ticker.
+
+    Parameters
+    ----------
+    rules: dict, optional
+        Rules by column, DAT_CLEAN_RULES by default
+    """
+    rules = DAT_CLEAN_RULES if rules is None else rules
+    df.columns = list(normalise_header(tuple(df.columns)))
+    n = len(df)
+
+    # Sorted codes, so that sorting codes sorts tickers and ISO dates.
+    # Missing tickers and dates are -1.
+    tic_codes, tickers = pd.factorize(df['ticker'], sort=True)
+    date_codes, _ = pd.factorize(df['date'], sort=True)
+
+    missing = (tic_codes < 0) | (date_codes < 0)
+    negative = np.zeros(n, dtype=bool)
+    fixes = {}
+    for col in df.columns:
+        if col in ('ticker', 'date'):
+            continue
+        if col not in rules and not pd.api.types.is_numeric_dtype(df[col]):
+            # Other columns, e.g. text, are only missing where they are NA
+            missing |= df[col].isna().to_numpy()
+            continue
+        rule = rules.get(col, DAT_DEFAULT_RULE)
+        values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        col_missing = np.isnan(values)
+        if rule.get('missing'):
+            col_missing |= np.isin(values, rule['missing'])
+        missing |= col_missing
+        col_negative = (values < 0) & ~col_missing
+        if rule.get('negative') == 'drop':
+            negative |= col_negative
+        elif rule.get('negative') == 'abs' and col_negative.any():
+            fixes[col] = (col_negative, values)
+    negative &= ~missing
+
+    # Kept rows in ticker and date order; lexsort is stable, so rows with
+    # the same ticker and date stay in file order
+    keep = ~(missing | negative)
+    order = np.lexsort((date_codes, tic_codes))
+    order = order[keep[order]]
+    duplicate = np.zeros(len(order), dtype=bool)
+    same_tic = tic_codes[order[1:]] == tic_codes[order[:-1]]
+    if drop_duplicates:
+        duplicate[1:] = same_tic & (date_codes[order[1:]] == date_codes[order[:-1]])
+    # A row is out of order when it comes before the previous row of its
+    # ticker in the file
+    moved = np.zeros(len(order), dtype=bool)
+    moved[1:] = same_tic & (order[1:] < order[:-1])
+    dropped_dup = order[duplicate]
+    order, moved = order[~duplicate], moved[~duplicate]
+
+    out = df.take(order)
+    fixed = np.zeros(n, dtype=bool)
+    for col, (col_negative, values) in fixes.items():
+        out[col] = np.abs(values[order])
+        fixed |= col_negative
+    if isinstance(prc_col, str) and prc_col in out.columns:
+        out = _rename_price(out, prc_col)
+
+    # Counts by ticker
+    ntic = len(tickers)
+    def count(rows):
+        # Number of the rows `rows` (positions in df) by ticker
+        codes = tic_codes[rows]
+        return np.bincount(codes[codes >= 0], minlength=ntic)
+    report = pd.DataFrame({
+        'rows_in': count(np.arange(n)),
+        'dropped_missing': count(np.flatnonzero(missing)),
+        'dropped_negative': count(np.flatnonzero(negative)),
+        'dropped_duplicate': count(dropped_dup),
+        'fixed_negative': count(order[fixed[order]]),
+        'fixed_order': count(order[moved]),
+        'rows_out': count(order),
+        }, index=pd.Index(tickers, name='ticker'))
+    return out, report
+
+def _iter_dat_chunks(pth, prc_col, chunksize, use_cache=False, tickers=None):
+    # Clean date/ticker/price frames of at most `chunksize` rows of the .dat
+    # file `pth`, in file order. The cached or selected frame is sorted by
+    # ticker and date instead, which keeps the file order of rows with equal
+    # keys.
+    if use_cache or tickers is not None:
+        df = read_dat(pth, prc_col, use_cache=use_cache, tickers=tickers)
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+        return
+
+    with _DatStream(pth) as stream:
+        reader = pd.read_csv(stream, chunksize=chunksize)
+        while True:
+            # Parsing happens when the next chunk is requested
+            with instrument.stage('read_dat') as rec:
+                chunk = next(reader, None)
+                if chunk is not None:
+                    chunk = to_canonical(clean_dat(chunk, prc_col)[0], price_cols(prc_col))
+                    rec['rows_out'] = len(chunk)
+                else:
+                    rec['skip'] = True
+            if chunk is None:
+                return
+            yield chunk
+
+def _read_dat_chunks(pth, prc_col, chunksize, use_cache=False, tickers=None):
+    # List of the chunks of _iter_dat_chunks, to be returned by a worker process
+    return list(_iter_dat_chunks(pth, prc_col, chunksize, use_cache, tickers))
+
+def _dat_pieces(pth, chunksize, tickers=None):
+    # Byte ranges of the .dat file `pth` grouped into pieces of about
+    # `chunksize` rows, in file order, along the blocks of its sidecar index.
+    # Only the blocks of `tickers` are kept. None if the file has no index.
+    blocks = _dat_index(pth)
+    if blocks is None:
+        return None
+    ranges = _select_dat_blocks(blocks, None if tickers is None else set(tickers))
+    with open(pth, 'rb') as fobj:
+        # Bytes per row, from the lines at the start of the file
+        fobj.readline()
+        sample = fobj.read(1 << 16)
+        target = max(1, chunksize * len(sample) // max(sample.count(b'\n'), 1))
+
+        # Blocks larger than a piece are cut at line ends
+        parts = []
+        for first, last in ranges:
+            while last - first > target:
+                fobj.seek(first + target)
+                fobj.readline()
+                cut = min(fobj.tell(), last)
+                parts.append([first, cut])
+                first = cut
+            if last > first:
+                parts.append([first, last])
+
+    pieces, size = [], 0
+    for first, last in parts:
+        if not pieces or size + last - first > target:
+            pieces.append([])
+            size = 0
+        pieces[-1].append([first, last])
+        size += last - first
+    return pieces
+
+def _read_dat_piece(pth, ranges, prc_col, tickers=None):
+    # Clean date/ticker/price frame of the byte `ranges` of the .dat file
+    # `pth`, as a list of one chunk, to be returned by a worker process
+    df = clean_dat(_read_dat_ranges(pth, ranges), prc_col)[0]
+    if tickers is not None:
+        df = df[df['ticker'].astype(str).str.upper().isin(tickers)]
+    return [to_canonical(df, price_cols(prc_col))]
+
+def _dat_jobs(dat_paths, prc_col, chunksize, use_cache, tickers):
+    # Jobs (function, arguments) of the process pool of iter_files, each
+    # returning a list of chunks of a DAT file, in file order
+    for pth in dat_paths:
+        pieces = None
+        if not use_cache and os.path.isfile(pth):
+            pieces = _dat_pieces(pth, chunksize, tickers)
+            if pieces is None:
+                warnings.warn(f'{pth} has no ticker or date column to index, so it is parsed by '
+                              'a single worker and held in memory whole', stacklevel=3)
+        if pieces is None:
+            yield _read_dat_chunks, (pth, prc_col, chunksize, use_cache, tickers)
+        else:
+            for ranges in pieces:
+                yield _read_dat_piece, (pth, ranges, prc_col, tickers)
+
+def _ordered_results(executor, jobs, ahead):
+    # Results of the `jobs` (function, arguments) run by `executor`, in the
+    # order of the jobs, with at most `ahead` of them submitted and not
+    # yet consumed
+    pending = collections.deque()
+    for func, args in jobs:
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, *args))
+    while pending:
+        yield pending.popleft().result()
+
+def _load_spill(pth):
+    # All the frames pickled one after the other into the file `pth`
+    frames = []
+    with open(pth, 'rb') as fobj:
+        while True:
+            try:
+                frames.append(pickle.load(fobj))
+            except EOFError:
+                return frames
+
+# Sort key of NaT dates, which sort last as in sort_values
+_NAT_KEY = np.iinfo(np.int64).max
+
+def _merge_runs(a, b):
+    # Merge of two runs (keys, rows), each sorted by unique keys. Rows of `a`
+    # win over rows of `b` with an equal key.
+    a_keys, a_rows = a
+    b_keys, b_rows = b
+    if not len(a_keys) or not len(b_keys):
+        return a if len(b_keys) == 0 else b
+    pos = np.searchsorted(a_keys, b_keys)
+    new = a_keys[np.minimum(pos, len(a_keys) - 1)] != b_keys
+    b_keys, b_rows, pos = b_keys[new], b_rows[new], pos[new]
+    # Each row of `b` goes before the rows of `a` with a larger key
+    from_b = np.zeros(len(a_keys) + len(b_keys), dtype=bool)
+    from_b[pos + np.arange(len(pos))] = True
+    keys = np.empty(len(from_b), dtype=a_keys.dtype)
+    rows = np.empty(len(from_b), dtype=a_rows.dtype)
+    keys[from_b], keys[~from_b] = b_keys, a_keys
+    rows[from_b], rows[~from_b] = b_rows, a_rows
+    return keys, rows
+
+@instrument.instrumented('merge_ticker')
+def _merge_ticker(frames):
+    # Frame of a single ticker from its CSV frames and then its DAT frames,
+    # sorted by date. CSV frames come first, so they win over DAT files on
+    # equal dates, and earlier frames win over later ones.
+    #
+    # Every frame is already sorted by date (except for the NaT of invalid
+    # dates), so the frames are merged pairwise as sorted runs, dropping
+    # repeated dates as they meet, rather than deduplicated and sorted as a
+    # whole.
+    dtype = ticker_dtype(set().union(*(df['ticker'].cat.categories for df in frames)))
+    prc_cols = [col for col in frames[0].columns if col not in ('date', 'ticker')]
+    dates = np.concatenate([df['date'].to_numpy() for df in frames])
+    prices = {col: np.concatenate([df[col].to_numpy() for df in frames]) for col in prc_cols}
+    codes = np.concatenate([df['ticker'].astype(dtype).cat.codes.to_numpy() for df in frames])
+    keys = dates.view(np.int64).copy()
+    keys[np.isnat(dates)] = _NAT_KEY
+
+    runs = []
+    start = 0
+    for df in frames:
+        run_keys = keys[start:start + len(df)]
+        rows = np.arange(start, start + len(df))
+        if np.any(run_keys[1:] < run_keys[:-1]):
+            order = np.argsort(run_keys, kind='stable')
+            run_keys, rows = run_keys[order], rows[order]
+        # The first of repeated dates within the run wins
+        first = np.ones(len(run_keys), dtype=bool)
+        first[1:] = run_keys[1:] != run_keys[:-1]
+        runs.append((run_keys[first], rows[first]))
+        start += len(df)
+
+    # Adjacent runs are merged, earlier runs winning, until one is left
+    while len(runs) > 1:
+        merged = [_merge_runs(runs[i], runs[i + 1]) for i in range(0, len(runs) - 1, 2)]
+        runs = merged + runs[len(runs) - len(runs) % 2:]
+    rows = runs[0][1]
+
+    data = {'date': dates[rows], 'ticker': pd.Categorical.from_codes(codes[rows], dtype=dtype)}
+    data.update((col, values[rows]) for col, values in prices.items())
+    return pd.DataFrame(data)
+
+def _parse_file(parse, pth):
+    # parse(pth), or None if the file `pth` does not exist
+    if not os.path.isfile(pth):
+        return None
+    return parse(pth)
+
+def _format_tickers(tickers):
+    return tickers.str.upper().str.replace(' ', '').str.replace('"', '')
+
+@instrument.instrumented('format_data_calc')
 def format_data_calc(df):
     # Formatting data types to align with docstring of calc_monthly_ret_and_vol
     df['date'] = pd.to_datetime(df['date'])
-    df['ticker'] = df['ticker'].str.upper().str.replace(' ', '').str.replace('"', '')
+    if isinstance(df['ticker'].dtype, pd.CategoricalDtype):
+        # Format the categories only, unless that merges or reorders them
+        categories = _format_tickers(df['ticker'].cat.categories)
+        if categories.is_unique and categories.is_monotonic_increasing:
+            df['ticker'] = df['ticker'].cat.rename_categories(categories)
+            return df
+        df['ticker'] = df['ticker'].astype(str)
+    df['ticker'] = _format_tickers(df['ticker'])
 
     return df
 
-def compute_daily_returns(df):
-    # Computing daily returns as 'dret' using percentage change
+@instrument.instrumented('compute_daily_returns')
+def compute_daily_returns(df, prc_cols=None):
+    # Computing daily returns as 'dret' using percentage change, or as
+    # dret_<col> for each of the price columns `prc_cols` in one groupby
     df = df.sort_values(by=['ticker', 'date'])
-    df['dret'] = df.groupby('ticker')['price'].pct_change()
+    if prc_cols is None:
+        df['dret'] = df.groupby('ticker', observed=True)['price'].pct_change()
+    else:
+        drets = df.groupby('ticker', observed=True)[list(prc_cols)].pct_change()
+        df[[f'dret_{col}' for col in prc_cols]] = drets.to_numpy()
 
     return df
 
+def month_key(dates):
+    # Integer month key year * 12 + month of a datetime column, used for
+    # grouping and joining instead of YYYY-MM strings
+    months = np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+    return (months + 1970 * 12 + 1).astype(np.int32)
+
+def month_str(keys):
+    # YYYY-MM strings of integer month keys from month_key
+    keys = np.asarray(keys, dtype=np.int64)
+    return (keys - 1970 * 12 - 1).astype('datetime64[M]').astype(str)
+
 def compute_monthly_returns(df):
-    df['mdate'] = df['date'].dt.to_period('M').astype(str)
+    # mdate is an integer month key, see month_key
+    df['mdate'] = month_key(df['date'])
     
     # Grouping by ticker and mdate to get the closing, last price of each month
-    close_price = df.groupby(['ticker', 'mdate'])['price'].last().reset_index()
+    close_price = df.groupby(['ticker', 'mdate'], observed=True)['price'].last().reset_index()
 
     # Compute the previous month's close, last price for each ticker
-    close_price['prev_price'] = close_price.groupby('ticker')['price'].shift(1)
+    close_price['prev_price'] = close_price.groupby('ticker', observed=True)['price'].shift(1)
 
     # Monthly Return = (Closing Price on Last Day of Month / Closing Price on Last Day of Previous Month) - 1
     close_price['mret'] = (close_price['price'] / close_price['prev_price']) - 1
@@ -81,16 +693,19 @@ def compute_monthly_returns(df):
     return close_price[['ticker', 'mdate', 'mret']]
 
 def compute_monthly_volatility(df):
-    df['mdate'] = df['date'].dt.to_period('M').astype(str)
+    # mdate is an integer month key, see month_key
+    df['mdate'] = month_key(df['date'])
     
     # Monthly Volatillity = Standard deviation of dret * sqrt(21)
-    m_vol = df.groupby(['ticker', 'mdate'])['dret'].agg(lambda x: np.std(x) * np.sqrt(21)).reset_index()
+    # Population standard deviation (ddof=0) skipping NaN, as np.std on a
+    # Series, but computed by a single cythonized grouped reduction
+    m_vol = (df.groupby(['ticker', 'mdate'], observed=True)['dret'].std(ddof=0) * np.sqrt(21)).reset_index()
     m_vol.rename(columns={'dret': 'mvol'}, inplace=True)
     
     return m_vol[['ticker', 'mdate', 'mvol']]
 
-def merge_monthly_data(monthly_returns, monthly_volatility):
-    # Merge the monthly return and volatility data
+def merge_monthly_data(monthly_returns, monthly_volatility, mdate_str=True):
+    # Merge the monthly return and volatility data on integer month keys
     monthly_data = pd.merge(monthly_returns, monthly_volatility, on=['ticker', 'mdate'])
     
     # Ensure casting of numeric types
@@ -99,21 +714,109 @@ def merge_monthly_data(monthly_returns, monthly_volatility):
 
     # Remove NaN results
     monthly_data.dropna(inplace=True)
+
+    # YYYY-MM strings are only built for the rows that are returned
+    if mdate_str:
+        monthly_data['mdate'] = month_str(monthly_data['mdate'])
     
     return monthly_data[['mdate', 'ticker', 'mret', 'mvol']]
 
+@instrument.instrumented('compute_monthly_data')
+def compute_monthly_data(df, mdate_str=True, prc_cols=None):
+    # Fused version of compute_monthly_returns, compute_monthly_volatility
+    # and merge_monthly_data. `df` must come from compute_daily_returns, so
+    # it is sorted by ticker and date and each ticker-month is a contiguous
+    # block of rows, reduced in one pass over NumPy arrays.
+    #
+    # With `prc_cols`, the price columns and their dret_<col> columns are
+    # reduced together as the columns of 2-d arrays, and the results have
+    # a prc_col column naming the price column of each row.
+    df = df[df['date'].notna()]
+    if prc_cols is None:
+        price_names, dret_names = ['price'], ['dret']
+    else:
+        price_names, dret_names = list(prc_cols), [f'dret_{col}' for col in prc_cols]
+    codes, uniques = pd.factorize(df['ticker'])
+    months = month_key(df['date'])
+    def columns(names):
+        # 2-d float array of the columns `names`, a view for a single column
+        arrays = [pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+                  for col in names]
+        return arrays[0][:, None] if len(arrays) == 1 else np.column_stack(arrays)
+    price = columns(price_names)
+    dret = columns(dret_names)
+
+    n = len(df)
+    if n == 0:
+        # Typed, so that concatenating it with other results keeps dtypes
+        monthly_data = pd.DataFrame({'mdate': months, 'ticker': np.empty(0, dtype=object),
+                                     'mret': np.empty(0), 'mvol': np.empty(0)})
+        if prc_cols is not None:
+            monthly_data.insert(2, 'prc_col', np.empty(0, dtype=object))
+        if mdate_str:
+            monthly_data['mdate'] = month_str(monthly_data['mdate'])
+        return monthly_data
+
+    # Start of each ticker and of each ticker-month block
+    new_tic = np.ones(n, dtype=bool)
+    new_tic[1:] = codes[1:] != codes[:-1]
+    new_grp = new_tic.copy()
+    new_grp[1:] |= months[1:] != months[:-1]
+    starts = np.flatnonzero(new_grp)
+    grp = np.cumsum(new_grp) - 1
+
+    # Closing, last non-missing price of each month
+    has_prc = ~np.isnan(price)
+    last_idx = np.maximum.reduceat(np.where(has_prc, np.arange(n)[:, None], -1), starts)
+    close = np.where(last_idx >= 0, np.take_along_axis(price, np.maximum(last_idx, 0), axis=0), np.nan)
+
+    # Monthly Return = (Closing Price on Last Day of Month / Closing Price on Last Day of Previous Month) - 1
+    prev_close = np.full(close.shape, np.nan)
+    prev_close[1:] = close[:-1]
+    prev_close[new_tic[starts]] = np.nan
+    mret = close / prev_close - 1
+
+    # Monthly Volatillity = Standard deviation of dret * sqrt(21)
+    # Population standard deviation skipping NaN, from the group means
+    has_ret = ~np.isnan(dret)
+    count = np.add.reduceat(has_ret.astype(np.int64), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(np.where(has_ret, dret, 0.0), starts) / count
+        dev = np.where(has_ret, dret - mean[grp], 0.0)
+        mvol = np.sqrt(np.add.reduceat(dev * dev, starts) / count) * np.sqrt(21)
+
+    # One row per ticker-month and price column, price columns varying fastest
+    k = len(price_names)
+    monthly_data = pd.DataFrame({
+        'mdate': np.repeat(months[starts], k),
+        'ticker': np.repeat(np.asarray(uniques.take(codes[starts]), dtype=object), k),
+        'mret': mret.ravel(),
+        'mvol': mvol.ravel(),
+        })
+    if prc_cols is not None:
+        monthly_data.insert(2, 'prc_col', np.tile(np.array(price_names, dtype=object), len(starts)))
+
+    # Remove NaN results
+    monthly_data = monthly_data.dropna().reset_index(drop=True)
+
+    if mdate_str:
+        monthly_data['mdate'] = month_str(monthly_data['mdate'])
+
+    return monthly_data
+
 ##################
 # Core Functions #
 ##################
 def rename_cols(
         df: pd.DataFrame,
-        prc_col: str = 'adj_close',
+        prc_col: str | list = 'adj_close',
         ) -> None:
     """ Rename the columns of `df` in place.
 
     Normalise the names of columns in a dataframe such that they are in
     snake case with no leading or trailing white spaces. The prc_col
     parameter indicates which column should be renamed to 'price'.
+    A list of columns is left under their own names.
     This function should be used in read_dat and read_csv.
 
     Parameters
@@ -127,20 +830,28 @@ def rename_cols(
 
 
     """
-    normalised_cols = []
-    for col in df.columns:
-        normalised_cols.append(normalise(col))
-    df.columns = normalised_cols
+    df.columns = list(normalise_header(tuple(df.columns)))
 
-    if prc_col in df.columns: 
+    if isinstance(prc_col, str) and prc_col in df.columns: 
+        if prc_col != 'price':
+            # The column asked for replaces a price column of the file
+            df.drop(columns='price', inplace=True, errors='ignore')
         df.rename(columns={prc_col: 'price'}, inplace=True)
 
 
 
 
+@instrument.instrumented('read_dat')
 def read_dat(
         pth,
-        prc_col: str = 'adj_close',
+        prc_col: str | list = 'adj_close',
+        use_cache: bool = False,
+        tickers: list | None = None,
+        start=None,
+        end=None,
+        export_dir: str | None = None,
+        rules: dict | None = None,
+        return_report: bool = False,
         ) -> pd.DataFrame:
     """ Returns a data frame with the relevant information from the .dat file
     `pah`
@@ -148,11 +859,43 @@ def read_dat(
 
     Parameters
     ----------
-    pth: str
-        Location of the .dat file to be read
+    pth: str or buffer
+        Location of the .dat file to be read, or its contents as an open
+        binary or text buffer (e.g. io.BytesIO)
 
-    prc_col: str
-        Which price column to use (close, open, etc...)
+    prc_col: str or list
+        Which price column to use (close, open, etc...), or a list of them
+        read from a single parse. With a list, each of them is returned as
+        a PRICE_DTYPE column under its own name instead of price
+
+    use_cache: bool
+        If True, the result is loaded from the on-disk cache (see
+        project2.cache) when the file has not changed since it was cached,
+        skipping parsing entirely. Otherwise it is parsed and cached.
+
+    tickers: list, optional
+        Only read these tickers
+
+    start, end: str or datetime, optional
+        Only read the dates from `start` to `end`, both included
+
+    With any of tickers, start or end, a sidecar index of the ticker blocks
+    of the file and of their dates is built on first use (<pth>.idx), and
+    only the blocks that may hold the selected rows are parsed.
+
+    export_dir: str, optional
+        If given, the cleaned data with all its columns is also written to
+        clean_data.dat in this folder (see new_run_dir). Nothing is exported
+        otherwise. The cache is then not loaded, since it only holds the
+        date, ticker and price columns.
+
+    rules: dict, optional
+        Cleaning rules by column, DAT_CLEAN_RULES by default (see clean_dat)
+
+    return_report: bool
+        If True, also returns the report of clean_dat, with the number of
+        rows dropped and fixed for each ticker. The cache is then not
+        loaded, since the report is made while cleaning.
 
 
 
@@ -167,65 +910,104 @@ def read_dat(
          1   ticker   
          2   price    
 
+        where
+            date is a datetime64 (NaT if invalid in the file)
 
+            ticker is categorical, with the categories of ticker_dtype
 
-    """
-    # Creates a new file comma_dat which has commas separating all values and tickers with no quotations
-    new_lines = []
-    if os.path.exists(pth):
-        with open(pth, 'r') as file:
-            content = file.readlines()
-            for line in content:
-                new_lines.append(" ".join(line.replace("'", "").split()))
-    comma_path = os.path.join(cfg.DATADIR, 'comma_dat.csv')
-
-    with open(comma_path, 'w') as new_file:
-        for line in new_lines:
-            changed_line = line.replace(' ', ',') + '\n'
-            changed_line = changed_line.replace(',,', ',')
-            new_file.write(changed_line)
-
-    # Any rows with -99 values are deleted in the dataframe
-    df = pd.read_csv(comma_path)
-
-    df.replace(-99, pd.NA, inplace=True)
-    df.dropna(inplace=True)
-
-    rename_cols(df, prc_col=prc_col)
-
-    # Sort values by ticker, then date
-    df = df.sort_values(by=['ticker', 'date'])
-
-    # Absolute values the negative values that seem consistent if they were positive
-    df['open'] = np.abs(df['open'])
+            price is a float of type PRICE_DTYPE
 
+    frame:
+        The report of clean_dat, only if return_report is True
 
 
-    # Creates a new file clean_data.dat which has all negative values removed
-    df.to_csv(os.path.join(cfg.DATADIR, 'clean_data.dat'), index=False)
 
-    return df[['date', 'ticker', 'price']]
+    """
+    selective = tickers is not None or start is not None or end is not None
+    if tickers is not None:
+        tickers = sorted({tic.upper() for tic in tickers})
+    if start is not None:
+        start = pd.Timestamp(start)
+    if end is not None:
+        end = pd.Timestamp(end)
+
+    key = None
+    if use_cache and _is_path(pth) and os.path.exists(pth):
+        params = {'prc_col': prc_col}
+        if selective:
+            params.update(tickers=tickers, start=start, end=end)
+        if rules is not None:
+            params['rules'] = rules
+        key = cache.fingerprint(pth, **params)
+        df = None if return_report or export_dir is not None else cache.load(key)
+        if df is not None:
+            return df
+
+    blocks = None
+    if selective and _is_path(pth) and os.path.exists(pth):
+        blocks = _dat_index(pth)
+    if blocks is not None:
+        # Only the ticker blocks which may hold selected rows are parsed
+        ranges = _select_dat_blocks(
+            blocks, None if tickers is None else set(tickers),
+            None if start is None else start.strftime('%Y-%m-%d'),
+            None if end is None else end.strftime('%Y-%m-%d'))
+        df = _read_dat_ranges(pth, ranges)
+    else:
+        # The .dat file is normalised to comma separated values (tickers with
+        # no quotations) as pandas reads it
+        with _DatStream(pth) as stream:
+            df = pd.read_csv(stream)
+
+    df, report = clean_dat(df, prc_col, rules)
+    if tickers is not None:
+        df = df[df['ticker'].astype(str).str.upper().isin(tickers)]
+
+    if export_dir is not None:
+        # clean_data.dat has all negative values removed
+        export_csv(df, export_dir, 'clean_data.dat')
+
+    df = to_canonical(df, price_cols(prc_col))
+    if start is not None:
+        df = df[df['date'] >= start]
+    if end is not None:
+        df = df[df['date'] <= end]
+    if key is not None:
+        cache.store(key, df)
+    if return_report:
+        if tickers is not None:
+            report = report[report.index.str.upper().isin(tickers)]
+        return df, report
+    return df
 
 
 
 
+@instrument.instrumented('read_csv')
 def read_csv(
         pth,
         ticker: str,
-        prc_col: str = 'adj_close',
+        prc_col: str | list = 'adj_close',
+        use_cache: bool = False,
         ) -> pd.DataFrame:
     """ Returns a DF with the relevant information from the CSV file `pth`
 
     Parameters
     ----------
-    pth: str
-        Location of the CSV file to be read
+    pth: str or buffer
+        Location of the CSV file to be read, or its contents as an open
+        buffer (e.g. io.BytesIO)
 
     ticker:
         Relevant ticker
 
-    prc_col: str
-        Which price column to use (close, open, etc...)
+    prc_col: str or list
+        Which price column to use (close, open, etc...), or a list of them
+        read from a single parse. With a list, each of them is returned as
+        a PRICE_DTYPE column under its own name instead of price
+
+    use_cache: bool
+        If True, use the on-disk cache as in read_dat
 
 
 
@@ -240,20 +1022,183 @@ def read_csv(
          1   ticker   
          2   price    
 
+        where
+            date is a datetime64 (NaT if invalid in the file)
+
+            ticker is categorical, with the categories of ticker_dtype
+
+            price is a float of type PRICE_DTYPE
+
 
     """
+    key = None
+    if use_cache and _is_path(pth) and os.path.exists(pth):
+        key = cache.fingerprint(pth, prc_col=prc_col, ticker=ticker.upper())
+        df = cache.load(key)
+        if df is not None:
+            return df
+
     df = pd.read_csv(pth)
     rename_cols(df, prc_col=prc_col)
     df['ticker'] = ticker.upper()
     df = df.sort_values(by=['ticker', 'date'])
 
-    return df[['date', 'ticker', 'price']]
+    df = to_canonical(df, price_cols(prc_col))
+    if key is not None:
+        cache.store(key, df)
+    return df
+
+
+@instrument.instrumented_iter('iter_files')
+def iter_files(
+        csv_tickers: list | None = None,
+        dat_files: list | None = None,
+        prc_col: str | list = 'adj_close',
+        chunksize: int = DAT_CHUNK_ROWS,
+        use_cache: bool = False,
+        workers: int = 1,
+        tickers: list | None = None,
+        ):
+    """ Read CSV and DAT files one ticker at a time. If an observation
+    [ticker, price] is present in both files, prioritize CSV
+
+    DAT files are parsed `chunksize` rows at a time and split by ticker.
+    Beyond `chunksize` rows held in memory, the split frames are written to
+    a temporary directory, removed once the last ticker is yielded, so
+    memory use is bounded by the largest ticker rather than by the whole
+    universe. DAT files of at most `chunksize` rows in all are not spilled.
+    With `tickers`, each DAT file also gets the sidecar index of
+    read_dat (<pth>.idx) next to it.
+
+    Parameters
+    ----------
+    csv_ticker: list, str, optional
+
+    dat_files: list, str, optional
+
+    prc_col: str or list
+        Which price to use (close, open, etc...), or a list of them
+        read from a single parse. With a list, each of them is returned as
+        a PRICE_DTYPE column under its own name instead of price
 
+    chunksize: int
+        Number of rows of a DAT file parsed at a time
+
+    use_cache: bool
+        If True, read each file through the on-disk cache (see read_dat)
+
+    workers: int
+        Number of processes parsing files in parallel. DAT files are split
+        into pieces of about `chunksize` rows along the ticker blocks of
+        their sidecar index (see read_dat), so a single large file is also
+        parsed in parallel. At most 2 * workers pieces, and then CSV files,
+        are parsed ahead of the ones being consumed, which keeps memory
+        bounded. A DAT file that cannot be indexed, or is read through the
+        cache, is parsed whole by one worker.
+
+    tickers: list, optional
+        Only read these tickers. DAT files then parse only the blocks of
+        these tickers (see read_dat).
+
+    Yields
+    ------
+    frame: 
+        A dataframe for a single ticker, in ticker order, with columns:
+    
+         #   Column   
+        ---  ------   
+         0   date     
+         1   ticker   
+         2   price    
+
+        where
+            date is a datetime64 (NaT if invalid in the file)
+
+            ticker is categorical, with the categories of ticker_dtype
+
+            price is a float of type PRICE_DTYPE
+
+        sorted by date
+    """
+    if tickers is not None:
+        tickers = sorted({tic.upper() for tic in tickers})
 
+    # CSV files by ticker
+    csv_paths = {}
+    if csv_tickers is not None:
+        for tic in csv_tickers:
+            if tickers is not None and tic.upper() not in tickers:
+                continue
+            pth = os.path.join(cfg.DATADIR, f'{tic.lower()}_prc.csv')
+            if os.path.isfile(pth):
+                csv_paths.setdefault(tic.upper(), []).append((pth, tic))
+    dat_paths = [os.path.join(cfg.DATADIR, f'{dat}') for dat in dat_files or []]
+
+    with contextlib.ExitStack() as stack:
+        spill_dir = None
+
+        if workers > 1:
+            # Results are consumed in submission order, so the output is the
+            # same as with sequential reads
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            dat_results = _ordered_results(
+                executor, _dat_jobs(dat_paths, prc_col, chunksize, use_cache, tickers), 2 * workers)
+            dat_chunks = (chunk for chunks in dat_results for chunk in chunks)
+        else:
+            dat_chunks = (chunk for pth in dat_paths
+                          for chunk in _iter_dat_chunks(pth, prc_col, chunksize, use_cache, tickers))
+
+        # Split the DAT files by ticker, keeping the order of the files. Split
+        # frames are held in memory up to `chunksize` rows, then all of them
+        # are appended to the spill file of their ticker.
+        spills = {}
+        held = {}
+        held_rows = 0
+        for chunk in dat_chunks:
+            for tic, df_tic in chunk.groupby('ticker', observed=True, sort=False):
+                held.setdefault(tic, []).append(df_tic)
+                held_rows += len(df_tic)
+            if held_rows <= chunksize:
+                continue
+            if spill_dir is None:
+                spill_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            for tic, frames in held.items():
+                if tic not in spills:
+                    spills[tic] = os.path.join(spill_dir, f'{len(spills)}.pkl')
+                with open(spills[tic], 'ab') as fobj:
+                    for df_tic in frames:
+                        pickle.dump(df_tic, fobj)
+            held, held_rows = {}, 0
+
+        all_tickers = sorted(set(csv_paths) | set(spills) | set(held))
+        if workers > 1:
+            # CSV files are read ahead in the order of the tickers
+            csv_results = _ordered_results(
+                executor, ((read_csv, (pth, t, prc_col, use_cache))
+                           for tic in all_tickers for pth, t in csv_paths.get(tic, [])),
+                2 * workers)
+
+        for tic in all_tickers:
+            if workers > 1:
+                frames = [next(csv_results) for _ in csv_paths.get(tic, [])]
+            else:
+                frames = [read_csv(pth, t, prc_col, use_cache) for pth, t in csv_paths.get(tic, [])]
+            if tic in spills:
+                frames.extend(_load_spill(spills[tic]))
+            frames.extend(held.pop(tic, []))
+
+            yield _merge_ticker(frames)
+
+
+@instrument.instrumented('read_files')
 def read_files(
         csv_tickers: list | None = None,
         dat_files: list | None = None,
-        prc_col: str = 'adj_close',
+        prc_col: str | list = 'adj_close',
+        use_cache: bool = False,
+        workers: int = 1,
+        tickers: list | None = None,
+        export_dir: str | None = None,
         ):
     """ Read CSV and DAT files. If an observation [ticker, price] is
     present in both files, prioritize CSV
@@ -264,8 +1209,26 @@ def read_files(
 
     dat_files: list, str, optional
 
-    prc_col: str
-        Which price to use (close, open, etc...). 
+    prc_col: str or list
+        Which price to use (close, open, etc...), or a list of them
+        read from a single parse. With a list, each of them is returned as
+        a PRICE_DTYPE column under its own name instead of price
+
+    use_cache: bool
+        If True, read each file through the on-disk cache (see read_dat)
+
+    workers: int
+        Number of processes parsing files in parallel
+
+    tickers: list, optional
+        Only read these tickers, which is pushed down to read_dat so DAT
+        files parse only their blocks
+
+    export_dir: str, optional
+        If given, the result is also written to read_files.csv in this
+        folder (see new_run_dir). Nothing is exported otherwise, though
+        iter_files still writes temporary files, and read_dat the sidecar
+        index of selective reads.
 
     Returns
     -------
@@ -277,38 +1240,125 @@ def read_files(
          0   date     
          1   ticker   
          2   price    
+
+        where
+            date is a datetime64 (NaT if invalid in the file)
+
+            ticker is categorical, with the categories of ticker_dtype
+
+            price is a float of type PRICE_DTYPE
     """
-    data = pd.DataFrame(columns=['date', 'ticker', 'price'])
+    chunks = list(iter_files(csv_tickers=csv_tickers, dat_files=dat_files,
+                             prc_col=prc_col, use_cache=use_cache, workers=workers,
+                             tickers=tickers))
+    if chunks:
+        data = _concat_canonical(chunks)
+    else:
+        data = to_canonical(pd.DataFrame(columns=['date', 'ticker'] + price_cols(prc_col)),
+                            price_cols(prc_col))
+
+    if export_dir is not None:
+        export_csv(data, export_dir, 'read_files.csv')
 
-    # Read from CSV files
-    if csv_tickers is not None:
-        for tic in csv_tickers:
-            if os.path.isfile((os.path.join(cfg.DATADIR, f'{tic.lower()}_prc.csv'))):
-                df_csv = read_csv(os.path.join(cfg.DATADIR, f'{tic.lower()}_prc.csv'), tic, prc_col)
-                data = pd.concat([data, df_csv], ignore_index=True)
+    return data
 
-    # Read from DAT files
-    if dat_files is not None:
-        for dat in dat_files:
-            df_dat = read_dat(os.path.join(cfg.DATADIR, f'{dat}'), prc_col)
-            data = pd.concat([data, df_dat], ignore_index=True)
 
-    data.drop_duplicates(subset=['date', 'ticker'], keep='first', inplace=True)
-    data = data.sort_values(by=['ticker', 'date'])
 
-    # Creates a new file for the output
-    data.to_csv(os.path.join(cfg.DATADIR, 'read_files.csv'), index=False)
+async def read_files_async(
+        csv_tickers: list | None = None,
+        dat_files: list | None = None,
+        prc_col: str | list = 'adj_close',
+        max_concurrency: int = 16,
+        tickers: list | None = None,
+        ):
+    """ Same as read_files, for a DATADIR where opening and reading a file
+    is slow compared to parsing it (e.g. a network mount).
+
+    Up to `max_concurrency` files are read and parsed at a time by a thread
+    pool, each by read_csv or read_dat from its path, so the event loop is
+    never blocked by a parse and files are streamed rather than loaded
+    whole. Parsing holds the GIL for part of the time, so the speedup comes
+    from overlapping the slow reads, not from parsing in parallel. Results
+    are merged in the same order as read_files, so the output does not
+    depend on which file finishes first. The frames of every file are held
+    in memory until all of them are read, as in read_files.
+
+    Example
+    -------
+    >> df = asyncio.run(read_files_async(['tsla'], ['data1.dat']))
 
-    return data
+    Parameters
+    ----------
+    csv_ticker: list, str, optional
+
+    dat_files: list, str, optional
+
+    prc_col: str or list
+        Which price to use (close, open, etc...), or a list of them
+        read from a single parse. With a list, each of them is returned as
+        a PRICE_DTYPE column under its own name instead of price
 
+    max_concurrency: int
+        Maximum number of files being read at the same time
 
+    tickers: list, optional
+        Only return these tickers
 
-def calc_monthly_ret_and_vol(df):
+    Returns
+    -------
+    frame:
+        The frame returned by read_files
+    """
+    # Imported here, as only this function needs it
+    import asyncio
+
+    if tickers is not None:
+        tickers = sorted({tic.upper() for tic in tickers})
+    csv_jobs = [(os.path.join(cfg.DATADIR, f'{tic.lower()}_prc.csv'), tic) for tic in csv_tickers or []
+                if tickers is None or tic.upper() in tickers]
+    dat_paths = [os.path.join(cfg.DATADIR, f'{dat}') for dat in dat_files or []]
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        async def load(pth, parse):
+            async with semaphore:
+                return await loop.run_in_executor(executor, _parse_file, parse, pth)
+
+        # gather returns the results in the order of the jobs
+        results = await asyncio.gather(
+            *[load(pth, functools.partial(read_csv, ticker=tic, prc_col=prc_col))
+              for pth, tic in csv_jobs],
+            *[load(pth, functools.partial(read_dat, prc_col=prc_col, tickers=tickers))
+              for pth in dat_paths])
+
+    # Frames by ticker, CSV files first and then DAT files, in the order of
+    # the arguments, as in iter_files
+    frames = {}
+    for df in results:
+        if df is None:
+            continue
+        for tic, df_tic in df.groupby('ticker', observed=True, sort=False):
+            frames.setdefault(tic, []).append(df_tic)
+    chunks = [_merge_ticker(frames[tic]) for tic in sorted(frames)]
+    if chunks:
+        return _concat_canonical(chunks)
+    return to_canonical(pd.DataFrame(columns=['date', 'ticker'] + price_cols(prc_col)),
+                        price_cols(prc_col))
+
+
+def calc_monthly_ret_and_vol(
+        df,
+        mdate_str: bool = True,
+        prc_cols: list | None = None,
+        use_cache: bool = False,
+        disk_cache: bool = False,
+        ):
     """ Compute monthly returns and volatility for each ticker in `df`.
 
     Parameters
     ----------
-    df: frame
+    df: frame or iterable of frames
         A data frame with columns
 
          #   Column
@@ -317,6 +1367,30 @@ def calc_monthly_ret_and_vol(df):
          1   ticker
          2   price
 
+        or an iterable of such frames, each holding whole tickers (e.g. the
+        output of iter_files). Each frame is processed on its own and the
+        results are concatenated.
+
+    mdate_str: bool
+        If False, mdate is returned as the int32 month key year * 12 + month
+        used internally, instead of a YYYY-MM string
+
+    prc_cols: list, optional
+        Price columns of `df` to use instead of price, e.g. those of a
+        frame read with a list prc_col. All of them are computed together
+        in the same groupby and reductions, and the result has a prc_col
+        column, after ticker, naming the price column of each row.
+
+    use_cache: bool
+        If True, results are memoized in memory, keyed by the content hash
+        of `df` (see cache.frame_hash), so calling again with the same data
+        returns them without computing them. For an iterable of frames,
+        each frame is memoized on its own.
+
+    disk_cache: bool
+        If True, results are also memoized on disk under cache.RESULTS_DIR,
+        so that they are reused by later runs. Implies use_cache.
+
 
     Returns
     -------
@@ -348,14 +1422,37 @@ def calc_monthly_ret_and_vol(df):
 
 
     """
+    if not isinstance(df, pd.DataFrame):
+        results = [calc_monthly_ret_and_vol(chunk, mdate_str=False, prc_cols=prc_cols,
+                                            use_cache=use_cache, disk_cache=disk_cache)
+                   for chunk in df]
+        if not results:
+            cols = ['mdate', 'ticker', 'mret', 'mvol'] if prc_cols is None else \
+                ['mdate', 'ticker', 'prc_col', 'mret', 'mvol']
+            return pd.DataFrame(columns=cols)
+        monthly_data = pd.concat(results, ignore_index=True)
+        if mdate_str:
+            monthly_data['mdate'] = month_str(monthly_data['mdate'])
+        return monthly_data
+
+    key = None
+    if use_cache or disk_cache:
+        key = cache.result_key('calc_monthly_ret_and_vol', CALC_VERSION, df,
+                               mdate_str=mdate_str, prc_cols=prc_cols)
+        monthly_data = cache.load_result(key, disk=disk_cache)
+        if monthly_data is not None:
+            return monthly_data
+
     # Computes the monthly returns and volatility for each ticker in 'df'
     df = format_data_calc(df)
-    df = compute_daily_returns(df)
-
-    monthly_returns = compute_monthly_returns(df)
-    monthly_volatility = compute_monthly_volatility(df)
-    
-    monthly_data = merge_monthly_data(monthly_returns, monthly_volatility)
+    df = compute_daily_returns(df, prc_cols)
+
+    # Last price, mret and mvol of every ticker-month in one pass, instead of
+    # compute_monthly_returns and compute_monthly_volatility followed by
+    # merge_monthly_data
+    monthly_data = compute_monthly_data(df, mdate_str=mdate_str, prc_cols=prc_cols)
+    if key is not None:
+        cache.store_result(key, monthly_data, disk=disk_cache)
     
     return monthly_data
     
@@ -364,6 +1461,7 @@ def main(
         csv_tickers: list | None = None,
         dat_files: list | None = None,
         prc_col: str = 'adj_close',
+        use_cache: bool = False,
         ):
     """ Perform the main analysis. Regressing month returns on lagged monthly
     volatility.
@@ -380,6 +1478,12 @@ def main(
     prc_col: str
         The name of the column in which price data is to be read.
 
+    use_cache: bool
+        If True, files are read through the on-disk cache (see read_dat),
+        and the monthly data of each ticker is memoized in memory and on
+        disk (see calc_monthly_ret_and_vol), so that a later run with the
+        same data only repeats the regression.
+
     Returns
     -------
     None
@@ -389,25 +1493,132 @@ def main(
     The function should print the summary results of a linear regression provided by
     the statsmodels package.
     """
-    df = read_files(csv_tickers=csv_tickers, dat_files=dat_files, prc_col=prc_col)
-    monthly_data = calc_monthly_ret_and_vol(df)
+    # One ticker at a time, so only the monthly data of the whole universe is
+    # held in memory
+    chunks = iter_files(csv_tickers=csv_tickers, dat_files=dat_files, prc_col=prc_col,
+                        use_cache=use_cache)
+    monthly_data = calc_monthly_ret_and_vol(chunks, mdate_str=False, use_cache=use_cache,
+                                            disk_cache=use_cache)
     
-    monthly_data['lagged_mvol'] = monthly_data.groupby('ticker')['mvol'].shift(1)
+    monthly_data['lagged_mvol'] = monthly_data.groupby('ticker', observed=True)['mvol'].shift(1)
     monthly_data.dropna(inplace=True)
 
+    # statsmodels takes longer to import than the rest of the package, so
+    # only runs that fit the model load it
+    import statsmodels.formula.api as smf
+
     # mret = intercept +  a * lagged_mvol + error
-    regression_model = smf.ols(formula='mret ~ lagged_mvol', data=monthly_data).fit()
+    with instrument.stage('fit', rows_in=len(monthly_data)):
+        regression_model = smf.ols(formula='mret ~ lagged_mvol', data=monthly_data).fit()
     print(regression_model.summary())
 
 
 ##################
 # Test Functions #
 ##################
+def test_normalise():
+    # The regular expressions should give the same names as the old loops
+    from project2 import bench
+    names = ['Adj  Close', 'TICKER', 'Date', 'Adj,Close', ' Open ', 'adjClose', 'AdjClose',
+             '__a__B', 'A', '', 'ÉtéABC']
+    print([normalise(name) for name in names] == [bench._normalise_legacy(name) for name in names])
+    print(normalise_header(('TICKER', 'Adj  Close', 'Date')))
+
 def test_read_dat():
     data1_path = os.path.join(cfg.DATADIR, 'data1.dat')
     df = (read_dat(data1_path, 'adj_close'))
     print(df)
 
+def test_read_dat_stream():
+    # The streaming parser should give the same frame as the old
+    # comma_dat.csv round-trip, whatever the chunk size
+    from project2 import bench
+    data1_path = os.path.join(cfg.DATADIR, 'data1.dat')
+    expected = to_canonical(bench._read_dat_legacy(data1_path, 'adj_close'))
+    print(expected.equals(read_dat(data1_path, 'adj_close')))
+
+    with _DatStream(data1_path, chunk_size=7) as small, _DatStream(data1_path) as large:
+        print(pd.read_csv(small).shape == pd.read_csv(large).shape)
+
+def test_read_dat_cache():
+    # A warm read should return the cold result without parsing the file,
+    # and invalidating the cache should remove its entry
+    data1_path = os.path.join(cfg.DATADIR, 'data1.dat')
+    cold = read_dat(data1_path, 'adj_close', use_cache=True)
+    warm = read_dat(data1_path, 'adj_close', use_cache=True)
+    print(cold.equals(warm) and cold.index.equals(warm.index))
+
+    # A warm read still exports the cleaned data with all its columns
+    with tempfile.TemporaryDirectory() as tmpdir:
+        read_dat(data1_path, 'adj_close', use_cache=True, export_dir=tmpdir)
+        print(pd.read_csv(os.path.join(tmpdir, 'clean_data.dat')).columns.tolist())
+    print(cache.invalidate(data1_path))
+
+def test_read_dat_index():
+    # Reading a few tickers or dates through the sidecar index should give
+    # the rows of a full read
+    data1_path = os.path.join(cfg.DATADIR, 'data1.dat')
+    full = read_dat(data1_path, 'adj_close').astype({'ticker': str}).reset_index(drop=True)
+    print(_dat_index(data1_path))
+
+    df = read_dat(data1_path, 'adj_close', tickers=['TSLA', 'ge'], start='2010-01-01', end='2012-06-30')
+    expected = full[full['ticker'].isin(['TSLA', 'GE']) & (full['date'] >= '2010-01-01')
+                    & (full['date'] <= '2012-06-30')]
+    print(expected.reset_index(drop=True).equals(df.astype({'ticker': str}).reset_index(drop=True)))
+
+    # read_files pushes its ticker filter down to read_dat
+    print(read_files(['TSLA'], ['data1.dat'], tickers=['TSLA', 'FB'])['ticker'].unique())
+
+    # The ticker and date columns are found by name, wherever the header has them
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pth = os.path.join(tmpdir, 'reordered.dat')
+        lines = open(data1_path).read().splitlines()
+        with open(pth, 'w') as fobj:
+            for line in lines:
+                fields = line.split(',')
+                fobj.write(','.join([fields[-1]] + fields[:-1]) + '\n')
+        full = read_dat(pth, 'adj_close').astype({'ticker': str}).reset_index(drop=True)
+        df = read_dat(pth, 'adj_close', tickers=['TSLA'])
+        expected = full[full['ticker'] == 'TSLA']
+        print(expected.reset_index(drop=True).equals(df.astype({'ticker': str}).reset_index(drop=True)))
+
+        # Without a ticker column, the file is parsed in full
+        with open(pth, 'w') as fobj:
+            fobj.write('\n'.join(line.split(',', 1)[-1] for line in lines) + '\n')
+        print(_dat_index(pth))
+
+def test_clean_dat():
+    # Rows dropped and fixed by clean_dat, by ticker
+    data = io.StringIO(
+        "Ticker,Volume,Open,Close,High,Low,Adj Close,Date\n"
+        "AAA,10,-1.0,1.0,1.0,1.0,1.0,2020-01-03\n"     # open fixed
+        "AAA,10,1.0,1.0,1.0,1.0,1.0,2020-01-02\n"      # out of order
+        "AAA,10,1.0,1.0,1.0,1.0,2.0,2020-01-02\n"      # duplicate date
+        "BBB,10,1.0,-99,1.0,1.0,1.0,2020-01-02\n"      # missing close
+        "BBB,10,1.0,1.0,1.0,1.0,-5.0,2020-01-03\n"     # negative price
+        "BBB,10,1.0,1.0,1.0,1.0,1.0,\n"                # missing date
+        "BBB,10,1.0,1.0,1.0,1.0,1.0,2020-01-06\n")
+    df, report = clean_dat(pd.read_csv(data))
+    print(df)
+    print(report)
+
+    # A rule keeping negative prices
+    rules = dict(DAT_CLEAN_RULES, adj_close={'missing': (-99,), 'negative': None})
+    data.seek(0)
+    print(clean_dat(pd.read_csv(data), rules=rules)[1])
+
+    # A text column without a rule only drops the rows where it is missing
+    data = io.StringIO(
+        "Ticker,Exchange,Open,Adj Close,Date\n"
+        "AAA,NYSE,1.0,1.0,2020-01-02\n"
+        "AAA,,1.0,1.0,2020-01-03\n"
+        "AAA,NYSE,1.0,-99,2020-01-06\n")
+    print(clean_dat(pd.read_csv(data))[0])
+
+    # The report of a .dat file
+    data1_path = os.path.join(cfg.DATADIR, 'data1.dat')
+    print(read_dat(data1_path, 'adj_close', return_report=True)[1])
+
 def test_read_csv_tsla():
     # tsla stock data
     tsla_pth = os.path.join(cfg.DATADIR, 'tsla_prc.csv')
@@ -417,11 +1628,33 @@ def test_read_csv_tsla():
     # The dataframe should be different when a different prc_col is chosen
     print(read_csv(tsla_pth, 'tsla', 'open'))
 
+    # Both price columns from a single parse
+    print(read_csv(tsla_pth, 'tsla', ['adj_close', 'open']))
+
+def test_multi_price():
+    # Monthly results of several price columns, read and computed together,
+    # should match one read and calc_monthly_ret_and_vol per column
+    cols = ['adj_close', 'close', 'open']
+    wide = read_files(['TSLA'], ['data1.dat'], prc_col=cols)
+    monthly_data = calc_monthly_ret_and_vol(wide, prc_cols=cols)
+    print(monthly_data)
+    for col in cols:
+        expected = calc_monthly_ret_and_vol(read_files(['TSLA'], ['data1.dat'], prc_col=col))
+        result = monthly_data[monthly_data['prc_col'] == col].drop(columns='prc_col')
+        print(col, expected.equals(result.reset_index(drop=True)))
+
+    # trf.dat has its own price column, replaced by the column asked for
+    trf_path = os.path.join(cfg.DATADIR, 'trf.dat')
+    df = read_dat(trf_path, 'close')
+    print(df.columns.tolist(), df['price'].head(3).tolist())
+
 def test_read_files():
     # Created two new files, trf.dat, and trf_prc.csv to test the read_files function with multiple files and stocks
-    read_files(['TRF', 'TSLA', 'A'], ['trf.dat', 'data1.dat'])
+    export_dir = new_run_dir()
+    read_files(['TRF', 'TSLA', 'A'], ['trf.dat', 'data1.dat'], export_dir=export_dir)
 
-    # Expected Results - will appear in read_files.csv
+    # Expected Results - will appear in read_files.csv, in export_dir
+    print(os.path.join(export_dir, 'read_files.csv'))
     # 1.) Include first half of TRF block in trf.dat (Second half of the block overlaps with trf_prc.csv)
 
     # 2.) Expects result to also add (1900-00-00) data to one of TSLA's result
@@ -429,11 +1662,200 @@ def test_read_files():
 
     # 3.) Expect to see a stock A (does not have an associated csv file, but has data in trf.dat)
 
+def test_read_files_async():
+    # With a slow open, reading the files concurrently should be faster than
+    # read_files and give the same frame
+    from project2 import bench
+    args = (['TRF', 'TSLA', 'A'], ['trf.dat', 'data1.dat'])
+    with bench.slow_open(0.2):
+        start = time.perf_counter()
+        expected = read_files(*args)
+        print('read_files', time.perf_counter() - start)
+
+        start = time.perf_counter()
+        import asyncio
+        df = asyncio.run(read_files_async(*args))
+        print('read_files_async', time.perf_counter() - start)
+    print(expected.equals(df))
+
+def test_iter_files():
+    # Concatenating the chunks should give the same panel as the old
+    # read_files, whatever the number of DAT rows parsed at a time
+    from project2 import bench
+    chunks = list(iter_files(['TRF', 'TSLA', 'A'], ['trf.dat', 'data1.dat'], chunksize=1000))
+    print([df['ticker'].iloc[0] for df in chunks])
+
+    # Invalid dates are NaT, which sorts last
+    expected = bench._read_files_legacy(['TRF', 'TSLA', 'A'], ['trf.dat', 'data1.dat'])
+    expected = to_canonical(expected).sort_values(by=['ticker', 'date'], ignore_index=True)
+    print(expected.equals(_concat_canonical(chunks)))
+
+    # With workers, DAT files are parsed in pieces of about chunksize rows,
+    # which should give the same chunks
+    for tickers in [None, ['TSLA', 'A']]:
+        sequential = _concat_canonical(list(iter_files(
+            ['TRF', 'TSLA', 'A'], ['trf.dat', 'data1.dat'], chunksize=1000, tickers=tickers)))
+        parallel = _concat_canonical(list(iter_files(
+            ['TRF', 'TSLA', 'A'], ['trf.dat', 'data1.dat'], chunksize=1000, workers=2, tickers=tickers)))
+        print(sequential.equals(parallel))
+
+def test_compute_monthly_volatility():
+    # The grouped reduction should match the per-group np.std lambda
+    from project2 import bench
+    data1_path = os.path.join(cfg.DATADIR, 'data1.dat')
+    df = compute_daily_returns(format_data_calc(read_dat(data1_path, 'adj_close')))
+
+    expected = bench._compute_monthly_volatility_legacy(df)
+    result = compute_monthly_volatility(df)
+    print(expected['ticker'].equals(result['ticker']))
+    print((expected['mdate'] == month_str(result['mdate'])).all())
+    print(np.allclose(expected['mvol'], result['mvol'], rtol=1e-12, atol=0, equal_nan=True))
+
+def test_compute_monthly_data():
+    # The fused aggregation should match compute_monthly_returns and
+    # compute_monthly_volatility merged by merge_monthly_data
+    from project2 import bench
+    data1_path = os.path.join(cfg.DATADIR, 'data1.dat')
+    df = read_dat(data1_path, 'adj_close')
+
+    expected = bench._calc_monthly_ret_and_vol_unfused(df.copy()).reset_index(drop=True)
+    result = calc_monthly_ret_and_vol(df.copy())
+    print(expected[['mdate', 'ticker']].astype(str).equals(result[['mdate', 'ticker']].astype(str)))
+    print(np.allclose(expected[['mret', 'mvol']], result[['mret', 'mvol']], rtol=1e-12, atol=0))
+
 def test_calc_monthly_ret_and_vol():
     data1_path = os.path.join(cfg.DATADIR, 'data1.dat')
     df = (read_dat(data1_path, 'adj_close'))
     print(calc_monthly_ret_and_vol(df))
 
+def test_incremental_update():
+    # Updating the monthly results day by day should give the same results
+    # as a full recompute
+    from project2 import incremental
+    daily = read_files(['tsla'], ['data1.dat'])
+    expected = calc_monthly_ret_and_vol(daily.copy())
+
+    dates = daily['date'].drop_duplicates().sort_values()
+    state = incremental.update(incremental.empty_state(), daily[daily['date'] < dates.iloc[-40]])
+    for date in dates.iloc[-40:]:
+        state = incremental.update(state, daily[daily['date'] == date])
+    result = incremental.monthly_results(state)
+
+    print(expected[['mdate', 'ticker']].astype(str).equals(result[['mdate', 'ticker']].astype(str)))
+    print(np.allclose(expected[['mret', 'mvol']], result[['mret', 'mvol']], rtol=1e-9, atol=0))
+
+def test_store():
+    # A store converted from the text files should give back the same panel
+    # and the same monthly results
+    from project2 import store
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prices = store.convert(os.path.join(tmpdir, 'prices.bin'), ['TSLA'], ['data1.dat'])
+        print(prices.tickers, len(prices))
+
+        expected = read_files(['TSLA'], ['data1.dat']).dropna(subset=['date'], ignore_index=True)
+        print(expected.equals(prices.to_frame()))
+
+        expected = calc_monthly_ret_and_vol(expected)
+        result = calc_monthly_ret_and_vol(prices.iter_frames())
+        print(expected[['mdate', 'ticker']].astype(str).equals(result[['mdate', 'ticker']].astype(str)))
+        print(np.allclose(expected[['mret', 'mvol']], result[['mret', 'mvol']], rtol=1e-12, atol=0))
+        print(type(prices.ticker_records('TSLA')))
+        del prices
+
+def test_calc_cache():
+    # A memoized call should return the same results, unchanged by edits of
+    # a previous result, and computed again once the data changes
+    df = read_files(['TSLA'], ['data1.dat'])
+    cache.clear_results()
+    for _ in range(2):
+        start = time.perf_counter()
+        monthly_data = calc_monthly_ret_and_vol(df, use_cache=True)
+        print(time.perf_counter() - start)
+    monthly_data.loc[0, 'mret'] = np.nan
+    print(calc_monthly_ret_and_vol(df, use_cache=True).equals(calc_monthly_ret_and_vol(df)))
+
+    df.loc[0, 'price'] = df.loc[0, 'price'] * 2
+    print(calc_monthly_ret_and_vol(df, use_cache=True).equals(calc_monthly_ret_and_vol(df)))
+    print(len(cache._results.frames), cache._results.nbytes)
+    cache.clear_results()
+
+def test_shared():
+    # Monthly results computed by worker processes over the panel in shared
+    # memory should match calc_monthly_ret_and_vol
+    from project2 import shared
+    df = read_files(['TSLA'], ['data1.dat'])
+    expected = calc_monthly_ret_and_vol(df.copy())
+    result = shared.calc_sharded(df, workers=2)
+    print(result)
+    print(expected.equals(result))
+
+    # Workers attach a shared frame from its descriptor alone
+    with shared.share(df) as panel:
+        print(panel.descriptor['columns'], len(panel))
+        with shared.attach(panel.descriptor) as attached:
+            print(attached.frame(0, 5))
+
+def test_batch_ols():
+    # One batch_ols call should match smf.ols fitted ticker by ticker
+    import statsmodels.formula.api as smf
+    monthly_data = calc_monthly_ret_and_vol(iter_files(['tsla'], ['data1.dat']))
+    monthly_data['lagged_mvol'] = monthly_data.groupby('ticker')['mvol'].shift(1)
+    monthly_data.dropna(inplace=True)
+
+    res = ols.batch_ols(monthly_data, 'mret', 'lagged_mvol', by='ticker')
+    print(res)
+    for tic, df in monthly_data.groupby('ticker'):
+        fit = smf.ols(formula='mret ~ lagged_mvol', data=df).fit()
+        tic_res = res[res['ticker'] == tic]
+        print(tic, np.allclose(tic_res['coef'], fit.params), np.allclose(tic_res['std_err'], fit.bse),
+              np.allclose(tic_res['t'], fit.tvalues), np.allclose(tic_res['r2'], fit.rsquared))
+
+def test_rolling_ols():
+    # Each 24-month window should match smf.ols refitted on that window
+    import statsmodels.formula.api as smf
+    monthly_data = calc_monthly_ret_and_vol(iter_files(['tsla'], ['data1.dat']), mdate_str=False)
+    monthly_data['lagged_mvol'] = monthly_data.groupby('ticker')['mvol'].shift(1)
+    monthly_data.dropna(inplace=True)
+
+    res = ols.rolling_ols(monthly_data, 'mret', 'lagged_mvol', window=24)
+    print(res)
+    for (tic, mdate), df in list(res.groupby(['ticker', 'mdate']))[::50]:
+        in_window = ((monthly_data['ticker'] == tic) & (monthly_data['mdate'] > mdate - 24)
+                     & (monthly_data['mdate'] <= mdate))
+        fit = smf.ols(formula='mret ~ lagged_mvol', data=monthly_data[in_window]).fit()
+        print(tic, month_str([mdate])[0], np.allclose(df['coef'], fit.params),
+              np.allclose(df['std_err'], fit.bse), np.allclose(df['r2'], fit.rsquared))
+
+def test_factor_regression():
+    # The monthly factors should compound the daily ones, and the batched
+    # factor regression should match smf.ols
+    import statsmodels.formula.api as smf
+    from project2 import factors
+    ff = pd.read_csv(os.path.join(cfg.DATADIR, 'ff_daily.csv'))
+    ff['mdate'] = month_key(pd.to_datetime(ff['Date']))
+    expected = ff.groupby('mdate')[['mkt-rf', 'smb', 'hml', 'rf']].apply(lambda g: (1 + g).prod() - 1)
+    print(np.allclose(expected, factors.monthly_factors().to_frame(mdate_str=False)[factors.FACTORS]))
+
+    monthly_data = calc_monthly_ret_and_vol(iter_files(['tsla'], ['data1.dat']), mdate_str=False)
+    monthly_data['lagged_mvol'] = monthly_data.groupby('ticker')['mvol'].shift(1)
+    res = factors.factor_regression(monthly_data)
+    print(res)
+    fit = smf.ols(formula='exret ~ lagged_mvol + mkt_rf + smb + hml',
+                  data=factors.add_factors(monthly_data).dropna()).fit()
+    print(np.allclose(res['coef'], fit.params), np.allclose(res['std_err'], fit.bse))
+
+def test_instrument():
+    # Every stage run by main should appear in the report, with a profile each
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with instrument.record(cprofile_dir=tmpdir) as report:
+            main(csv_tickers=['tsla'], dat_files=['data1.dat'], prc_col='adj_close')
+        print(pd.DataFrame(report.to_dict()).T)
+        print(sorted(os.listdir(tmpdir)))
+
+    with instrument.record() as report:
+        calc_monthly_ret_and_vol(read_files(['tsla'], ['data1.dat']))
+    print(report.to_json())
+
 def test_tsla_regression():
     main(csv_tickers=['tsla'], prc_col='adj_close')
 
@@ -442,10 +1864,28 @@ def test_tsla_data1_regression():
 
 if __name__ == "__main__":
     pass
+    #test_normalise()
     #test_read_csv_tsla()
     #test_read_dat()
+    #test_read_dat_stream()
+    #test_read_dat_cache()
+    #test_read_dat_index()
+    #test_clean_dat()
     #test_read_files()
+    #test_read_files_async()
+    #test_iter_files()
+    #test_compute_monthly_volatility()
+    #test_compute_monthly_data()
     #test_calc_monthly_ret_and_vol()
+    #test_multi_price()
+    #test_incremental_update()
+    #test_store()
+    #test_shared()
+    #test_calc_cache()
+    #test_batch_ols()
+    #test_rolling_ols()
+    #test_factor_regression()
+    #test_instrument()
     #test_tsla_regression()
     #test_tsla_data1_regression()
 
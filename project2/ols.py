@@ -0,0 +1,309 @@
+""" ols.py
+
+Batched ordinary least squares on NumPy arrays. Fits one regression per
+group of a data frame in a single call, without building a formula or a
+design matrix per fit.
+"""
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+
+####################
+# Helper Functions #
+####################
+def _as_list(cols):
+    if cols is None:
+        return []
+    if isinstance(cols, str):
+        return [cols]
+    return list(cols)
+
+def _group_sums(values, grp, ngroups):
+    # Sum of `values` (rows x ...) by group, for each trailing column
+    values = values.reshape(len(values), -1)
+    out = np.empty((ngroups, values.shape[1]))
+    for j in range(values.shape[1]):
+        out[:, j] = np.bincount(grp, weights=values[:, j], minlength=ngroups)
+    return out
+
+
+##################
+# Core Functions #
+##################
+def fit_arrays(
+        X: np.ndarray,
+        y: np.ndarray,
+        grp: np.ndarray,
+        ngroups: int,
+        const: bool = True,
+        ) -> dict:
+    """ Fit y = X b + e separately for each group of rows.
+
+    Parameters
+    ----------
+    X: array
+        Regressors, rows x k, including the constant column if any
+
+    y: array
+        Dependent variable
+
+    grp: array
+        Group number in [0, ngroups) of each row
+
+    ngroups: int
+        Number of groups
+
+    const: bool
+        Whether X includes a constant, in which case R2 is centered
+
+    Returns
+    -------
+    dict:
+        Arrays 'coef', 'std_err', 't' (ngroups x k) and 'r2', 'nobs'
+        (ngroups). Statistics of groups without enough observations are NaN.
+    """
+    n, k = X.shape
+    nobs = np.bincount(grp, minlength=ngroups).astype(float)
+
+    # X'X and X'y of every group, from the products of pairs of columns
+    XtX = _group_sums(X[:, :, None] * X[:, None, :], grp, ngroups).reshape(ngroups, k, k)
+    Xty = _group_sums(X * y[:, None], grp, ngroups)
+
+    # Pseudo-inverse, as statsmodels, so collinear groups do not fail
+    XtX_inv = np.linalg.pinv(XtX)
+    coef = np.einsum('gij,gj->gi', XtX_inv, Xty)
+
+    # Residuals in a second pass, which is more accurate than y'y - b'X'y
+    resid = y - np.einsum('ij,ij->i', X, coef[grp])
+    ssr = np.bincount(grp, weights=resid ** 2, minlength=ngroups)
+    if const:
+        ybar = np.bincount(grp, weights=y, minlength=ngroups) / np.maximum(nobs, 1)
+        tss = np.bincount(grp, weights=(y - ybar[grp]) ** 2, minlength=ngroups)
+    else:
+        tss = np.bincount(grp, weights=y ** 2, minlength=ngroups)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        df_resid = nobs - k
+        sigma2 = np.where(df_resid > 0, ssr / df_resid, np.nan)
+        std_err = np.sqrt(sigma2[:, None] * np.diagonal(XtX_inv, axis1=1, axis2=2))
+        t = coef / std_err
+        r2 = 1 - ssr / tss
+
+    coef[nobs < k] = np.nan
+    return {'coef': coef, 'std_err': std_err, 't': t, 'r2': r2, 'nobs': nobs}
+
+
+def batch_ols(
+        df: pd.DataFrame,
+        y: str,
+        x: str | list,
+        by: str | list | None = None,
+        const: bool = True,
+        ) -> pd.DataFrame:
+    """ Regress `y` on `x` (plus an intercept) for every group of `by` in
+    one call. Rows with a missing value in `y`, `x` or `by` are dropped, as
+    statsmodels does.
+
+    Parameters
+    ----------
+    df: frame
+        Data with the columns `y`, `x` and `by`
+
+    y: str
+        Dependent variable
+
+    x: str, list
+        Regressor(s)
+
+    by: str, list, optional
+        Columns defining the groups. If None, a single pooled regression is
+        fitted.
+
+    const: bool
+        Whether to add an intercept, named 'Intercept' as in statsmodels
+        formulas
+
+    Returns
+    -------
+    frame:
+        One row per group and term, with columns:
+
+         #   Column
+        ---  ------
+         0   <by columns>
+         1   term
+         2   coef
+         3   std_err
+         4   t
+         5   r2
+         6   nobs
+    """
+    x = _as_list(x)
+    by = _as_list(by)
+    df = df.dropna(subset=[y] + x + by)
+
+    if by:
+        grp, groups = pd.MultiIndex.from_frame(df[by]).factorize()
+        ngroups = len(groups)
+    else:
+        grp, groups, ngroups = np.zeros(len(df), dtype=np.intp), None, 1
+
+    terms = (['Intercept'] if const else []) + x
+    X = df[x].to_numpy(dtype=float)
+    if const:
+        X = np.column_stack([np.ones(len(df)), X])
+    res = fit_arrays(X, df[y].to_numpy(dtype=float), grp, ngroups, const=const)
+
+    k = len(terms)
+    out = pd.DataFrame({
+        'term': np.tile(terms, ngroups),
+        'coef': res['coef'].ravel(),
+        'std_err': res['std_err'].ravel(),
+        't': res['t'].ravel(),
+        'r2': np.repeat(res['r2'], k),
+        'nobs': np.repeat(res['nobs'], k).astype(int),
+        })
+    if groups is not None:
+        keys = groups.to_frame(index=False, name=by).loc[np.repeat(np.arange(ngroups), k)]
+        out = pd.concat([keys.reset_index(drop=True), out], axis=1)
+    return out
+
+
+def _window_sums(cum, left, right):
+    # Sums of the rows [left, right) from the cumulative sums `cum`, which
+    # start with a row of zeros
+    return cum[right] - cum[left]
+
+
+def rolling_ols(
+        df: pd.DataFrame,
+        y: str,
+        x: str,
+        window: int | None = 60,
+        by: str | list | None = 'ticker',
+        time: str = 'mdate',
+        min_nobs: int | None = None,
+        ) -> pd.DataFrame:
+    """ Regress `y` on `x` and an intercept over a window of `window` months
+    ending at every month, for every group of `by`, or pooled across all
+    rows if `by` is None.
+
+    The sums of x, y, xy, x^2 and y^2 are accumulated once, so the
+    statistics of each window come from a difference of two running sums
+    rather than from a refit.
+
+    Parameters
+    ----------
+    df: frame
+        Data with the columns `y`, `x`, `time` and `by`
+
+    y: str
+        Dependent variable
+
+    x: str
+        Regressor
+
+    window: int, optional
+        Length of the window in months, e.g. 60. If None, the window is
+        expanding, from the first month of each group.
+
+    by: str, list, optional
+        Columns defining the groups, 'ticker' by default. If None, one
+        pooled regression is fitted for each month over all rows.
+
+    time: str
+        Month of each row, either as the integer key year * 12 + month or
+        as a YYYY-MM string
+
+    min_nobs: int, optional
+        Windows with fewer observations are dropped. Defaults to `window`,
+        or 3 for an expanding window.
+
+    Returns
+    -------
+    frame:
+        One row per group, month and term, with columns:
+
+         #   Column
+        ---  ------
+         0   <by columns>
+         1   <time>
+         2   term
+         3   coef
+         4   std_err
+         5   t
+         6   r2
+         7   nobs
+    """
+    by = _as_list(by)
+    if min_nobs is None:
+        min_nobs = 3 if window is None else window
+    df = df.dropna(subset=[y, x, time] + by)
+
+    months = df[time]
+    if not pd.api.types.is_integer_dtype(months):
+        # YYYY-MM strings
+        months = months.astype(str)
+        months = months.str[:4].astype(int) * 12 + months.str[5:7].astype(int)
+    months = months.to_numpy(dtype=np.int64)
+
+    if by:
+        grp, _ = pd.MultiIndex.from_frame(df[by]).factorize()
+    else:
+        grp = np.zeros(len(df), dtype=np.intp)
+    order = np.lexsort((months, grp))
+    df, grp, months = df.iloc[order], grp[order], months[order]
+
+    # Centering keeps the running sums small, which limits cancellation
+    xv = df[x].to_numpy(dtype=float)
+    yv = df[y].to_numpy(dtype=float)
+    mx, my = xv.mean(), yv.mean()
+    xc, yc = xv - mx, yv - my
+    cum = np.zeros((len(df) + 1, 6))
+    cum[1:] = np.cumsum(np.column_stack([np.ones(len(df)), xc, yc, xc * xc, xc * yc, yc * yc]), axis=0)
+
+    # Windows end with the last row of each group and month, and start
+    # with the first row of the group within `window` months
+    n = len(df)
+    is_last = np.ones(n, dtype=bool)
+    is_last[:-1] = (grp[1:] != grp[:-1]) | (months[1:] != months[:-1])
+    ends = np.flatnonzero(is_last)
+    grp_start = np.searchsorted(grp, grp, side='left')
+    right = ends + 1
+    if window is None:
+        left = grp_start[ends]
+    else:
+        key = grp.astype(np.int64) * (months.max() - months.min() + window + 1) + months
+        left = np.searchsorted(key, key[ends] - window + 1, side='left')
+        left = np.maximum(left, grp_start[ends])
+
+    nobs, sx, sy, sxx, sxy, syy = _window_sums(cum, left, right).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xbar, ybar = sx / nobs, sy / nobs
+        vxx = sxx - sx * xbar
+        vxy = sxy - sx * ybar
+        vyy = syy - sy * ybar
+        beta = vxy / vxx
+        alpha = ybar - beta * xbar + my - beta * mx
+        ssr = np.maximum(vyy - beta * vxy, 0)
+        sigma2 = np.where(nobs > 2, ssr / (nobs - 2), np.nan)
+        se_beta = np.sqrt(sigma2 / vxx)
+        se_alpha = np.sqrt(sigma2 * (1 / nobs + (xbar + mx) ** 2 / vxx))
+        r2 = beta * vxy / vyy
+
+    keep = nobs >= min_nobs
+    rows = ends[keep]
+    coef = np.column_stack([alpha, beta])[keep]
+    std_err = np.column_stack([se_alpha, se_beta])[keep]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = coef / std_err
+    out = df[by + [time]].iloc[np.repeat(rows, 2)].reset_index(drop=True)
+    out['term'] = np.tile(['Intercept', x], len(rows))
+    out['coef'] = coef.ravel()
+    out['std_err'] = std_err.ravel()
+    out['t'] = t.ravel()
+    out['r2'] = np.repeat(r2[keep], 2)
+    out['nobs'] = np.repeat(nobs[keep], 2).astype(int)
+    return out
@@ -0,0 +1,273 @@
+""" shared.py
+
+Hand-off of the daily panel and of the monthly results between processes
+through multiprocessing.shared_memory, instead of pickling frames to and
+from every worker.
+
+A frame is shared as one block of shared memory per column. Ticker columns
+are shared as their categorical codes, with the tickers listed in the
+descriptor. Workers receive only the descriptor (block names, dtypes,
+number of rows and tickers), a few hundred bytes, and attach the blocks as
+NumPy arrays without copying them. calc_sharded also has the workers write
+their monthly results into their own rows of shared result columns, so a
+row count is all that is pickled back.
+
+Example
+-------
+>> df = read_files(...)
+>> shared.calc_sharded(df, workers=4)
+
+>> with shared.share(df) as panel:
+>>     executor.submit(func, panel.descriptor)   # func calls shared.attach
+"""
+from __future__ import annotations
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from project2 import main
+
+
+# Columns of the monthly results written by the workers of calc_sharded,
+# with mdate as an integer month key and ticker and prc_col as codes
+RESULT_DTYPES = {'mdate': np.int32, 'ticker': np.int32, 'prc_col': np.int16,
+                 'mret': np.float64, 'mvol': np.float64}
+
+
+####################
+# Helper Functions #
+####################
+def _attach_block(name):
+    # Attach the shared memory block `name` created by another process.
+    # Before Python 3.13 the block is also registered with the resource
+    # tracker, which worker processes share with the process that created
+    # it, so the registration is dropped when the creator unlinks it.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def _shard_bounds(codes, n_shards):
+    # Row offsets splitting the ticker-sorted codes `codes` into at most
+    # `n_shards` shards of whole tickers with about the same number of rows
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, int)
+    targets = np.linspace(0, len(codes), n_shards + 1)[1:-1]
+    cuts = starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)] if len(starts) else []
+    return np.unique(np.r_[0, cuts, len(codes)]).astype(np.int64)
+
+def _count_groups(panel, start, stop):
+    # Upper bound of the number of ticker-months of the rows `start` to
+    # `stop`: the number of runs of equal ticker and month
+    codes = panel.arrays['ticker'][start:stop]
+    months = main.month_key(panel.arrays['date'][start:stop])
+    new = np.ones(len(codes), dtype=bool)
+    new[1:] = (codes[1:] != codes[:-1]) | (months[1:] != months[:-1])
+    return int(new.sum())
+
+def _calc_shard(panel_descriptor, result_descriptor, start, stop, offset, prc_cols):
+    # Worker of calc_sharded: monthly results of the rows `start` to `stop`
+    # of the shared panel, written to the shared results from row `offset`.
+    # Returns the number of rows written.
+    panel = attach(panel_descriptor)
+    results = attach(result_descriptor)
+    try:
+        monthly_data = main.calc_monthly_ret_and_vol(
+            panel.frame(start, stop), mdate_str=False, prc_cols=prc_cols)
+        n = len(monthly_data)
+        rows = slice(offset, offset + n)
+        out = results.arrays
+        out['mdate'][rows] = monthly_data['mdate'].to_numpy()
+        out['ticker'][rows] = pd.Index(results.tickers).get_indexer(monthly_data['ticker'])
+        if prc_cols is not None:
+            out['prc_col'][rows] = pd.Index(prc_cols).get_indexer(monthly_data['prc_col'])
+        out['mret'][rows] = monthly_data['mret'].to_numpy()
+        out['mvol'][rows] = monthly_data['mvol'].to_numpy()
+        del monthly_data, out
+        return n
+    finally:
+        panel.close()
+        results.close()
+
+
+##################
+# Core Functions #
+##################
+class SharedFrame:
+    """ Columns of a frame held in shared memory, as NumPy arrays. Created
+    by share or empty (which own the blocks and unlink them on close), or
+    by attach in another process.
+    """
+    def __init__(self, descriptor: dict, blocks: dict, owner: bool):
+        self.descriptor = descriptor
+        self.tickers = descriptor['tickers']
+        self.owner = owner
+        self._blocks = blocks
+        # np.frombuffer holds on to the buffer of each block, so that closing
+        # a block still in use raises a BufferError rather than unmapping it
+        self.arrays = {
+            col: np.frombuffer(blocks[col].buf, dtype=np.dtype(dtype), count=descriptor['rows'])
+            for col, _, dtype in descriptor['columns']}
+
+    def __len__(self):
+        return self.descriptor['rows']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def frame(self, start: int = 0, stop: int | None = None) -> pd.DataFrame:
+        """ Rows `start` to `stop` as a read-only frame over the shared
+        arrays, with a categorical ticker column. It must not be used once
+        the SharedFrame is closed.
+        """
+        data = {}
+        for col, values in self.arrays.items():
+            values = values[start:stop]
+            values.flags.writeable = False
+            if col == 'ticker':
+                values = pd.Categorical.from_codes(values, dtype=main.ticker_dtype(self.tickers))
+            data[col] = values
+        return pd.DataFrame(data, copy=False)
+
+    def close(self) -> None:
+        """ Detach the blocks, and unlink them if this process created them.
+        Raises a BufferError if frames of `frame` are still in use.
+        """
+        self.arrays = {}
+        blocks, self._blocks = self._blocks, {}
+        if self.owner:
+            for block in blocks.values():
+                block.unlink()
+        for block in blocks.values():
+            block.close()
+
+
+def empty(dtypes: dict, rows: int, tickers: list | None = None) -> SharedFrame:
+    """ New SharedFrame of `rows` rows with the columns and NumPy dtypes of
+    `dtypes`. A ticker column holds codes into `tickers`.
+    """
+    blocks, columns = {}, []
+    try:
+        for col, dtype in dtypes.items():
+            dtype = np.dtype(dtype)
+            # A block cannot be empty
+            blocks[col] = shared_memory.SharedMemory(create=True, size=max(rows * dtype.itemsize, 1))
+            columns.append((col, blocks[col].name, dtype.str))
+    except BaseException:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+        raise
+    descriptor = {'rows': rows, 'columns': columns, 'tickers': list(tickers or [])}
+    return SharedFrame(descriptor, blocks, owner=True)
+
+
+def share(df: pd.DataFrame) -> SharedFrame:
+    """ Copy the canonical frame `df` (date, ticker and price columns, as
+    returned by read_files) to shared memory. The ticker column is shared as
+    its categorical codes.
+    """
+    ticker = df['ticker']
+    if not isinstance(ticker.dtype, pd.CategoricalDtype):
+        ticker = ticker.astype(main.ticker_dtype(ticker.dropna().unique()))
+    tickers = [str(tic) for tic in ticker.cat.categories]
+    columns = {col: ticker.cat.codes.to_numpy() if col == 'ticker' else df[col].to_numpy()
+               for col in df.columns}
+    panel = empty({col: values.dtype for col, values in columns.items()}, len(df), tickers)
+    for col, values in columns.items():
+        panel.arrays[col][:] = values
+    return panel
+
+
+def attach(descriptor: dict) -> SharedFrame:
+    """ Attach the SharedFrame of `descriptor`, created by another process
+    """
+    blocks = {}
+    try:
+        for col, name, _ in descriptor['columns']:
+            blocks[col] = _attach_block(name)
+    except BaseException:
+        for block in blocks.values():
+            block.close()
+        raise
+    return SharedFrame(descriptor, blocks, owner=False)
+
+
+def calc_sharded(
+        df: pd.DataFrame,
+        workers: int | None = None,
+        mdate_str: bool = True,
+        prc_cols: list | None = None,
+        shards: int | None = None,
+        ) -> pd.DataFrame:
+    """ calc_monthly_ret_and_vol on `workers` processes, each computing
+    shards of whole tickers. The panel and the results go through shared
+    memory, so only descriptors and row counts are pickled.
+
+    Parameters
+    ----------
+    df: frame
+        A canonical daily frame as returned by read_files, sorted by ticker
+        (it is sorted here otherwise)
+
+    workers: int, optional
+        Number of processes, os.cpu_count() by default
+
+    mdate_str, prc_cols:
+        As in calc_monthly_ret_and_vol
+
+    shards: int, optional
+        Number of shards, 4 per worker by default, so that a slow shard does
+        not hold up the others
+
+    Returns
+    -------
+    frame:
+        The frame returned by calc_monthly_ret_and_vol(df)
+    """
+    workers = workers or os.cpu_count() or 1
+    shards = shards or 4 * workers
+    if not isinstance(df['ticker'].dtype, pd.CategoricalDtype):
+        df = df.astype({'ticker': main.ticker_dtype(df['ticker'].dropna().unique())})
+    codes = df['ticker'].cat.codes.to_numpy()
+    if np.any(codes[1:] < codes[:-1]):
+        df = df.iloc[np.argsort(codes, kind='stable')]
+
+    with share(df) as panel:
+        bounds = _shard_bounds(panel.arrays['ticker'], shards)
+        # Each shard writes at most one row per ticker-month and price column
+        k = 1 if prc_cols is None else len(prc_cols)
+        sizes = [k * _count_groups(panel, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        offsets = np.r_[0, np.cumsum(sizes)].astype(np.int64)
+        # Tickers as formatted by calc_monthly_ret_and_vol
+        tickers = sorted(set(main._format_tickers(pd.Index(panel.tickers))))
+        with empty(RESULT_DTYPES, int(offsets[-1]), tickers) as results:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                counts = list(executor.map(
+                    _calc_shard, repeat(panel.descriptor), repeat(results.descriptor),
+                    bounds[:-1], bounds[1:], offsets[:-1], repeat(prc_cols)))
+
+            # Rows written by each shard, in shard (ticker) order
+            rows = np.concatenate([np.arange(start, start + n) for start, n in zip(offsets, counts)]
+                                  + [np.zeros(0, dtype=np.int64)])
+            out = {col: values[rows] for col, values in results.arrays.items()}
+
+    monthly_data = pd.DataFrame({
+        'mdate': out['mdate'],
+        'ticker': np.asarray(tickers, dtype=object)[out['ticker']] if tickers else
+            np.empty(0, dtype=object),
+        'mret': out['mret'],
+        'mvol': out['mvol'],
+        })
+    if prc_cols is not None:
+        monthly_data.insert(2, 'prc_col', np.asarray(prc_cols, dtype=object)[out['prc_col']])
+    if mdate_str:
+        monthly_data['mdate'] = main.month_str(monthly_data['mdate'])
+    return monthly_data
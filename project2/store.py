@@ -0,0 +1,185 @@
+""" store.py
+
+Binary store of the daily date/ticker/price panel, so that an analysis run
+does not parse the text files again.
+
+A store is made of two files:
+
+    <pth>       fixed-width records (int32 ticker id, int32 day number,
+                float64 price), sorted by ticker and date, and opened with
+                np.memmap
+
+    <pth>.idx   the tickers, in ticker id order, and the offset of the
+                first record of each ticker, so the history of a ticker is
+                a slice of the records
+
+Example
+-------
+>> store.convert(pth, csv_tickers=['tsla'], dat_files=['data1.dat'])
+>> prices = store.open_store(pth)
+>> calc_monthly_ret_and_vol(prices.iter_frames())
+"""
+from __future__ import annotations
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from project2 import main
+
+
+RECORD_DTYPE = np.dtype([('ticker', '<i4'), ('day', '<i4'), ('price', '<f8')])
+
+INDEX_EXT = '.idx'
+
+# dtype of the dates parsed by main.to_canonical, whose resolution depends
+# on the version of pandas
+DATE_DTYPE = pd.to_datetime(pd.Series(['1970-01-01']), format='ISO8601').dtype
+
+
+####################
+# Helper Functions #
+####################
+def _to_records(df, ticker_id):
+    # Records of the date/ticker/price frame `df` of a single ticker, sorted
+    # by date. Rows with an invalid date are dropped.
+    df = df[df['date'].notna()].sort_values(by='date', kind='stable')
+    records = np.empty(len(df), dtype=RECORD_DTYPE)
+    records['ticker'] = ticker_id
+    records['day'] = df['date'].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
+    records['price'] = df['price'].to_numpy(dtype=float, na_value=np.nan)
+    return records
+
+
+##################
+# Core Functions #
+##################
+class PriceStore:
+    """ Read-only view of a store written by write or convert. Records are
+    memory mapped, so opening a store reads only its index.
+    """
+    def __init__(self, pth):
+        with np.load(pth + INDEX_EXT) as index:
+            self.tickers = [str(tic) for tic in index['tickers']]
+            self.offsets = index['offsets']
+        self._ids = {tic: i for i, tic in enumerate(self.tickers)}
+        if self.offsets[-1] > 0:
+            self.records = np.memmap(pth, dtype=RECORD_DTYPE, mode='r')
+        else:
+            # np.memmap cannot map an empty file
+            self.records = np.empty(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, ticker):
+        return ticker in self._ids
+
+    def ticker_records(self, ticker: str) -> np.ndarray:
+        """ Records of `ticker`, as a view of the memory mapped file
+        """
+        i = self._ids[ticker]
+        return self.records[self.offsets[i]:self.offsets[i + 1]]
+
+    def frame(self, ticker: str) -> pd.DataFrame:
+        """ date/ticker/price frame of `ticker`, with the dtypes returned by
+        read_files, sorted by date
+        """
+        records = self.ticker_records(ticker)
+        dtype = main.ticker_dtype([ticker])
+        codes = np.full(len(records), dtype.categories.get_loc(ticker))
+        return pd.DataFrame({
+            'date': records['day'].astype('datetime64[D]').astype(DATE_DTYPE),
+            'ticker': pd.Categorical.from_codes(codes, dtype=dtype),
+            'price': records['price'].astype(main.PRICE_DTYPE),
+            })
+
+    def iter_frames(self, tickers: list | None = None):
+        """ Yields the frame of each of `tickers`, or of every ticker of the
+        store, as iter_files does
+        """
+        for tic in self.tickers if tickers is None else tickers:
+            yield self.frame(tic)
+
+    def to_frame(self, tickers: list | None = None) -> pd.DataFrame:
+        """ date/ticker/price frame of `tickers`, or of the whole store, as
+        returned by read_files
+        """
+        frames = list(self.iter_frames(tickers))
+        if not frames:
+            return main.to_canonical(pd.DataFrame(columns=['date', 'ticker', 'price']))
+        return main._concat_canonical(frames)
+
+
+def write(frames, pth) -> None:
+    """ Write a store to `pth` (records) and `pth`.idx (index)
+
+    Parameters
+    ----------
+    frames: frame or iterable of frames
+        date/ticker/price frame, or frames each holding whole tickers (e.g.
+        the output of iter_files), which are written one at a time
+    """
+    if isinstance(frames, pd.DataFrame):
+        frames = (df for _, df in frames.groupby('ticker', observed=True, sort=False))
+
+    # Ticker frames may come in any order, so their records are written as
+    # they come and the index records where each one starts
+    tmp = f'{pth}.{os.getpid()}.tmp'
+    blocks = {}
+    pos = 0
+    with open(tmp, 'wb') as fobj:
+        for df in frames:
+            for tic, df_tic in df.groupby(df['ticker'].astype(str), sort=False):
+                records = _to_records(df_tic, len(blocks))
+                blocks.setdefault(tic, []).append((pos, len(records)))
+                fobj.write(records.tobytes())
+                pos += len(records)
+
+    # Rewrite in ticker order unless the blocks are already one per ticker,
+    # sorted by ticker
+    tickers = sorted(blocks)
+    in_order = (list(blocks) == tickers and all(len(b) == 1 for b in blocks.values()))
+    if not in_order and pos > 0:
+        src = np.memmap(tmp, dtype=RECORD_DTYPE, mode='r')
+        sorted_tmp = tmp + '.sorted'
+        with open(sorted_tmp, 'wb') as fobj:
+            for i, tic in enumerate(tickers):
+                records = np.concatenate([src[start:start + n] for start, n in blocks[tic]])
+                records['ticker'] = i
+                records = records[np.argsort(records['day'], kind='stable')]
+                fobj.write(records.tobytes())
+        del src
+        os.replace(sorted_tmp, tmp)
+
+    counts = [sum(n for _, n in blocks[tic]) for tic in tickers]
+    offsets = np.zeros(len(tickers) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    # Index first, records last, so a store is complete once its records
+    # have their final name
+    idx_tmp = f'{pth}{INDEX_EXT}.{os.getpid()}.tmp'
+    with open(idx_tmp, 'wb') as fobj:
+        np.savez(fobj, tickers=np.array(tickers, dtype=str), offsets=offsets)
+    os.replace(idx_tmp, pth + INDEX_EXT)
+    os.replace(tmp, pth)
+
+
+def convert(
+        pth,
+        csv_tickers: list | None = None,
+        dat_files: list | None = None,
+        prc_col: str = 'adj_close',
+        ) -> PriceStore:
+    """ Convert the CSV and DAT files read by read_files to a store at `pth`,
+    one ticker at a time, and return it opened
+    """
+    write(main.iter_files(csv_tickers=csv_tickers, dat_files=dat_files, prc_col=prc_col), pth)
+    return open_store(pth)
+
+
+def open_store(pth) -> PriceStore:
+    """ Open the store written to `pth`
+    """
+    return PriceStore(pth)